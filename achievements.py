@@ -0,0 +1,118 @@
+import logging
+from collections import OrderedDict, defaultdict
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+# 成就规则：triggers 为订阅的事件类型，condition 接收事件携带的数据（facts）
+# min_points 表示纯积分门槛成就，可以在批量加分时用一条 SQL 统一判定
+class Achievement:
+    def __init__(self, name, reward, triggers, condition=None, min_points=None):
+        self.name = name
+        self.reward = reward
+        self.triggers = frozenset(triggers)
+        self.min_points = min_points
+        if condition is None:
+            condition = lambda facts: facts.get("points", 0) >= min_points
+        self.condition = condition
+
+
+# 事件类型：play（完成一局）、big_win（单局赢得 >= 500）、message（发言加分）、points（积分变动）
+ACHIEVEMENTS = [
+    Achievement("新手玩家", 10, {"play"}, lambda facts: True),
+    Achievement("连胜大师", 50, {"play"}, lambda facts: facts.get("consecutive_wins", 0) >= 3),
+    Achievement("积分达人", 20, {"points"}, min_points=100),
+    Achievement("活跃分子", 30, {"message"}, lambda facts: facts.get("activity", 0) >= 50),
+    Achievement("大赢家", 40, {"big_win"}, lambda facts: True),
+]
+
+
+# 增量成就引擎：按事件类型索引规则，内存中缓存每个用户已解锁的成就，只评估订阅了当前事件且尚未解锁的规则；
+# 解锁记录和奖励积分合并为一次事务写入。缓存最多保留 max_users 个最近访问的用户，淘汰后下次访问重新加载
+# （解锁写入是条件插入，重新加载后重复判定也不会重复发奖）
+class AchievementEngine:
+    def __init__(self, storage, rules=ACHIEVEMENTS, max_users=100000):
+        self.storage = storage
+        self.rules = rules
+        self.max_users = max_users
+        self._by_trigger = defaultdict(list)
+        for rule in rules:
+            for trigger in rule.triggers:
+                self._by_trigger[trigger].append(rule)
+        self._unlocked = OrderedDict()
+
+    def _cached(self, user_id):
+        names = self._unlocked.get(user_id)
+        if names is not None:
+            self._unlocked.move_to_end(user_id)
+        return names
+
+    def _store(self, user_id, loaded):
+        names = self._unlocked.setdefault(user_id, set())
+        names.update(loaded)
+        while len(self._unlocked) > self.max_users:
+            self._unlocked.popitem(last=False)
+        return names
+
+    # 用户已解锁的成就名称集合（未缓存时从数据库加载）
+    async def unlocked(self, user_id):
+        names = self._cached(user_id)
+        metrics.cache_lookup("achievements", names is not None)
+        if names is None:
+            names = self._store(user_id, await self.storage.load_unlocked(user_id))
+        return names
+
+    # 批量预加载一批用户的解锁记录（启动预热用），已缓存的用户跳过，返回加载的用户数
+    async def preload(self, user_ids):
+        user_ids = [user_id for user_id in user_ids if user_id not in self._unlocked][:self.max_users]
+        if user_ids:
+            for user_id, loaded in (await self.storage.load_unlocked_many(user_ids)).items():
+                self._store(user_id, loaded)
+        return len(user_ids)
+
+    # 处理一次事件，返回解锁提示
+    async def check(self, user_id, triggers, facts):
+        names = self._cached(user_id)
+        if names is not None and not self._pending_rules(names, triggers):
+            return []
+        names = await self.unlocked(user_id)
+        facts = dict(facts)
+        triggers = set(triggers)
+        unlocked = []
+        while True:
+            rules = [rule for rule in self._pending_rules(names, triggers) if rule.condition(facts)]
+            if not rules:
+                break
+            for rule in rules:
+                names.add(rule.name)
+                unlocked.append(rule)
+                facts["points"] = facts.get("points", 0) + rule.reward
+            # 奖励积分本身也是一次积分变动
+            triggers = {"points"}
+        if not unlocked:
+            return []
+        try:
+            credited = await self.storage.save_unlocks(user_id, [(rule.name, rule.reward) for rule in unlocked])
+        except Exception:
+            names.difference_update(rule.name for rule in unlocked)
+            raise
+        return [f"🎉 恭喜解锁成就：{rule.name}！奖励 {rule.reward} 积分！" for rule in unlocked if rule.name in credited]
+
+    # 积分门槛类成就
+    def threshold_rules(self):
+        return [rule for rule in self.rules if rule.min_points is not None]
+
+    # 批量解锁后同步内存缓存（只更新已加载的用户）
+    def mark_unlocked(self, name, user_ids):
+        for user_id in user_ids:
+            names = self._unlocked.get(user_id)
+            if names is not None:
+                names.add(name)
+
+    def _pending_rules(self, names, triggers):
+        rules = []
+        for trigger in triggers:
+            rules.extend(rule for rule in self._by_trigger.get(trigger, ()) if rule.name not in names and rule not in rules)
+        return rules
@@ -0,0 +1,116 @@
+import asyncio
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+class _UserActivity:
+    __slots__ = ("last_message", "activity", "chats")
+
+    def __init__(self, last_message, activity):
+        self.last_message = last_message
+        self.activity = activity
+        self.chats = set()
+
+
+# 发言积分的写回缓冲：冷却判断、+1 积分和活跃分子进度都在内存中完成，定期合并为一次事务写入数据库。
+# 冷却期内的消息不访问数据库；崩溃时最多丢失 flush_interval 秒内的发言积分
+class ActivityTracker:
+    def __init__(self, storage, achievement_engine=None, cooldown=60, flush_interval=5.0):
+        self.storage = storage
+        self.achievement_engine = achievement_engine
+        self.cooldown = cooldown
+        self.flush_interval = flush_interval
+        self._users = {}
+        # user_id -> [username, points, activity, last_message]
+        self._pending = {}
+        # 新出现的 (chat_id, user_id)
+        self._members = set()
+        self._task = None
+        self._stopping = None
+
+    # 记录一条发言；冷却中返回 None，否则返回成就引擎所需的 {"activity"}
+    # chat_id 为群聊 ID，用于分群排行榜；私聊传 None
+    async def record(self, user_id, username, now, chat_id=None):
+        state = self._users.get(user_id)
+        if state is None:
+            last_message, activity = await self.storage.load_activity(user_id)
+            state = self._users.setdefault(user_id, _UserActivity(last_message, activity))
+        if chat_id is not None and chat_id not in state.chats:
+            state.chats.add(chat_id)
+            self._members.add((chat_id, user_id))
+        if state.last_message and (now - state.last_message).total_seconds() <= self.cooldown:
+            return None
+        state.last_message = now
+        state.activity += 1
+        pending = self._pending.get(user_id)
+        if pending is None:
+            self._pending[user_id] = [username, 1, 1, now]
+        else:
+            pending[0] = username or pending[0]
+            pending[1] += 1
+            pending[2] += 1
+            pending[3] = now
+        return {"activity": state.activity}
+
+    # 把缓冲区写入数据库
+    async def flush(self):
+        if not self._pending and not self._members:
+            self._evict()
+            return
+        batch, self._pending = self._pending, {}
+        members, self._members = self._members, set()
+        rows = [(user_id, username, points, activity, last_message.isoformat())
+                for user_id, (username, points, activity, last_message) in batch.items()]
+        try:
+            balances = await self.storage.flush_activity(rows, list(members))
+        except Exception:
+            self._members |= members
+            # 写入失败时放回缓冲区，下次重试
+            for user_id, pending in batch.items():
+                current = self._pending.get(user_id)
+                if current is None:
+                    self._pending[user_id] = pending
+                else:
+                    current[1] += pending[1]
+                    current[2] += pending[2]
+            raise
+        self._evict()
+        if self.achievement_engine is not None:
+            for user_id, points in balances:
+                await self.achievement_engine.check(user_id, ("points",), {"points": points})
+
+    # 冷却已过且没有待写数据的用户不必常驻内存，下次发言时重新加载
+    def _evict(self):
+        now = datetime.now()
+        expired = [user_id for user_id, state in self._users.items()
+                   if user_id not in self._pending
+                   and (not state.last_message or (now - state.last_message).total_seconds() > self.cooldown)]
+        for user_id in expired:
+            del self._users[user_id]
+
+    # 停止时不取消任务：正在进行的写入已从缓冲区取出批次，取消会丢失这批数据，因此用事件通知循环结束
+    async def _run(self):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing chat activity: {str(e)}")
+
+    def start(self):
+        if self._task is None:
+            self._stopping = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    # 等待进行中的写入完成后再写入剩余的缓冲区（上次写入失败时会在这里重试一次）
+    async def stop(self):
+        if self._task is not None:
+            self._stopping.set()
+            await self._task
+            self._task = None
+        await self.flush()
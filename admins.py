@@ -0,0 +1,62 @@
+import asyncio
+import logging
+import time
+
+from telegram import Chat, ChatMember
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+ADMIN_STATUSES = (ChatMember.ADMINISTRATOR, ChatMember.OWNER)
+
+
+# 群管理员缓存：每个群的管理员列表缓存 ttl 秒，同一个群的并发查询合并为一次 API 调用；
+# static_admins 为固定管理员 user_id，私聊（无法查询管理员）时只认这份名单
+class AdminCache:
+    def __init__(self, ttl=300, static_admins=()):
+        self.ttl = ttl
+        self.static_admins = frozenset(static_admins)
+        # chat_id -> (过期时间, 管理员 user_id 集合)
+        self._cache = {}
+        self._inflight = {}
+
+    async def is_admin(self, bot, chat, user_id):
+        if user_id in self.static_admins:
+            return True
+        if chat.type == Chat.PRIVATE:
+            return False
+        return user_id in await self.admins(bot, chat.id)
+
+    async def admins(self, bot, chat_id):
+        entry = self._cache.get(chat_id)
+        hit = entry is not None and entry[0] > time.monotonic()
+        metrics.cache_lookup("admins", hit)
+        if hit:
+            return entry[1]
+        task = self._inflight.get(chat_id)
+        if task is None:
+            task = self._inflight[chat_id] = asyncio.ensure_future(self._fetch(bot, chat_id))
+            task.add_done_callback(lambda _: self._inflight.pop(chat_id, None))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, bot, chat_id):
+        admins = await bot.get_chat_administrators(chat_id)
+        user_ids = {admin.user.id for admin in admins}
+        self._cache[chat_id] = (time.monotonic() + self.ttl, user_ids)
+        return user_ids
+
+    def invalidate(self, chat_id):
+        self._cache.pop(chat_id, None)
+
+    # 根据 chat_member 更新维护缓存：成员升降管理员时直接修改缓存集合
+    def on_member_update(self, chat_member_updated):
+        chat_id = chat_member_updated.chat.id
+        entry = self._cache.get(chat_id)
+        if entry is None:
+            return
+        user_id = chat_member_updated.new_chat_member.user.id
+        if chat_member_updated.new_chat_member.status in ADMIN_STATUSES:
+            entry[1].add(user_id)
+        else:
+            entry[1].discard(user_id)
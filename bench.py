@@ -0,0 +1,260 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+# 离线基准测试：用 FakeRequest 代替 Telegram，把合成的 Update 直接交给 build_application 注册的真实处理器，
+# 统计处理延迟、每条更新的 SQL 语句/事务提交/API 调用次数和吞吐量，并与保存的基线比较
+# 用法：
+#   python bench.py                         运行全部负载并与 bench_baseline.json 比较
+#   python bench.py -w play -w chatters --scale 0.1
+#   python bench.py --save-baseline         把本次结果写为新的基线
+#   python bench.py --dice-rolls 10000000   骰子随机数统计自检（运行全部负载时默认 300 万次）
+
+ADMIN_ID = 42
+SEED = 20240101
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+
+PLAY_COMMANDS = ["/play size big 10", "/play size small 10", "/play parity odd 5", "/play sum 10 5",
+                 "/play sum 4 1", "/play triple any 2", "/play triple 6 1", "/play pair any 3",
+                 "/play pair 1-1-2 1", "/play single 3 5"]
+MIXED_TEXTS = ["你好", "今天手气怎么样", "/play size big 10", "/play sum 10 5", "/balance", "/leaderboard",
+               "/leaderboard global", "/achievements"]
+
+
+# 一种负载：预置 users 个用户，回放 updates 条更新，texts(rng) 生成每条消息的文本；setup(bot, chats) 在回放前执行
+class Workload:
+    def __init__(self, name, description, users, updates, chats, texts, user_ids=None, setup=None):
+        self.name = name
+        self.description = description
+        self.users = users
+        self.updates = updates
+        self.chats = chats
+        self.texts = texts
+        self.user_ids = user_ids
+        self.setup = setup
+
+    def scaled(self, scale):
+        return max(1, int(self.users * scale)), max(1, int(self.updates * scale))
+
+
+async def _enable_rounds(bot, chats):
+    for chat_id in range(1, chats + 1):
+        await bot.round_manager.set_seconds(-chat_id, 60)
+
+
+WORKLOADS = {workload.name: workload for workload in [
+    Workload("chatters", "10k users chatting in 50 groups", users=10000, updates=20000, chats=50,
+             texts=lambda rng: rng.choice(["你好", "哈哈", "今天手气怎么样", "冲冲冲"])),
+    Workload("play", "/play storm from 1k users in 20 groups", users=1000, updates=5000, chats=20,
+             texts=lambda rng: rng.choice(PLAY_COMMANDS)),
+    Workload("rounds", "the /play storm with round mode on in every group", users=1000, updates=5000, chats=20,
+             texts=lambda rng: rng.choice(PLAY_COMMANDS), setup=_enable_rounds),
+    Workload("addallpoints", "/addallpoints over 100k users", users=100000, updates=5, chats=1,
+             texts=lambda rng: "/addallpoints 10", user_ids=lambda rng, users: ADMIN_ID),
+    Workload("mixed", "chat, play, balance and leaderboard mix", users=1000, updates=5000, chats=10,
+             texts=lambda rng: rng.choice(MIXED_TEXTS)),
+]}
+
+
+def _percentile(values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+# 在当前进程中运行一种负载（由 main 在独立子进程中调用，保证每种负载使用全新的数据库和缓存）
+async def run_workload(workload, scale, concurrency, latency):
+    from telegram import Update
+
+    import bot
+    from fake_telegram import FakeRequest, make_update
+
+    rng = random.Random(SEED)
+    random.seed(SEED)
+    users, count = workload.scaled(scale)
+    request = FakeRequest(admin_ids=[ADMIN_ID], latency=latency)
+    app = bot.build_application("123456:BENCH", request=request)
+    # 冷启动：初始化（含数据库迁移）到可以接收更新的耗时；后台的指令菜单同步和缓存预热不计入负载统计
+    started = time.perf_counter()
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    ready = time.perf_counter() - started
+    await bot.startup_tasks.join()
+
+    rows = [(user_id, f"user{user_id}", 1000000, None, 0) for user_id in range(1, users + 1)]
+    for start in range(0, len(rows), 10000):
+        await bot.storage.import_rows("users", rows[start:start + 10000])
+    if workload.setup:
+        await workload.setup(bot, workload.chats)
+    updates = []
+    for update_id in range(1, count + 1):
+        user_id = workload.user_ids(rng, users) if workload.user_ids else rng.randint(1, users)
+        data = make_update(update_id, user_id, -rng.randint(1, workload.chats), workload.texts(rng))
+        updates.append(Update.de_json(data, app.bot))
+
+    query_stats = bot.storage.track_queries()
+    request.reset()
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def process(update):
+        async with semaphore:
+            started = time.perf_counter()
+            await app.process_update(update)
+            latencies.append(time.perf_counter() - started)
+
+    # 第一条更新单独处理，记录从就绪到处理完第一条更新的耗时；吞吐量按全部 count 条更新计时，包含第一条
+    started = time.perf_counter()
+    await process(updates[0])
+    first_update = time.perf_counter() - started
+    await asyncio.gather(*(process(update) for update in updates[1:]))
+    # 轮次模式下立即开奖，结算计入本次统计
+    await bot.round_manager.close_all()
+    # 发言积分是写回缓冲，计入最后一次落盘
+    await bot.activity_tracker.flush()
+    elapsed = time.perf_counter() - started
+
+    await app.shutdown()
+    if app.post_shutdown:
+        await app.post_shutdown(app)
+
+    latencies.sort()
+    return {
+        "users": users,
+        "updates": count,
+        "elapsed_s": round(elapsed, 3),
+        "updates_per_s": round(count / elapsed, 1),
+        "p50_ms": round(_percentile(latencies, 0.50) * 1000, 3),
+        "p99_ms": round(_percentile(latencies, 0.99) * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3),
+        "ready_ms": round(ready * 1000, 3),
+        "first_update_ms": round(first_update * 1000, 3),
+        "queries_per_update": round(query_stats["queries"] / count, 3),
+        "commits_per_update": round(query_stats["commits"] / count, 3),
+        "api_calls_per_update": round(sum(request.calls.values()) / count, 3),
+        "api_calls": dict(request.calls),
+    }
+
+
+def _run_one(args):
+    workload = WORKLOADS[args.run_one]
+    os.environ["DATABASE_URL"] = os.path.join(tempfile.mkdtemp(), "bench.db")
+    # 测的是处理能力，关闭入站和出站限流
+    for name in ("RATE_LIMIT_USER", "RATE_LIMIT_CHAT", "RATE_LIMIT_OUTGOING", "RATE_LIMIT_GROUP_CHAT",
+                 "RATE_LIMIT_PRIVATE_CHAT"):
+        os.environ[name] = "1000000/1"
+    os.environ["RATE_LIMIT_COMMANDS"] = ""
+    result = asyncio.run(run_workload(workload, args.scale, args.concurrency, args.latency))
+    print(json.dumps(result))
+
+
+# 越小越好的指标；updates_per_s 越大越好
+LOWER_IS_BETTER = ["p50_ms", "p99_ms", "queries_per_update", "commits_per_update", "api_calls_per_update"]
+
+
+def _compare(name, result, baseline, tolerance):
+    regressions = []
+    for metric in ["updates_per_s"] + LOWER_IS_BETTER:
+        old, new = baseline.get(metric), result[metric]
+        if not old:
+            continue
+        change = (new - old) / old
+        worse = change < -tolerance if metric == "updates_per_s" else change > tolerance
+        if worse:
+            regressions.append(metric)
+        print(f"  {metric:22} {old:>12} -> {new:<12} {change:+.1%}{'  REGRESSION' if worse else ''}")
+    return regressions
+
+
+# 骰子随机数自检：两种结果流各生成 rolls 个骰子做卡方检验，p 值低于 alpha 视为失败
+def _dice_self_test(rolls, alpha):
+    from dice import SeededStream, SystemStream, self_test
+
+    failures = []
+    for name, stream in (("system", SystemStream()), ("commit", SeededStream())):
+        result = self_test(stream, rolls)
+        print(f"== dice.{name}: {result['rolls']} rolls, {result['rolls_per_s']} rolls/s")
+        for test in ("faces", "combos"):
+            failed = result[f"{test}_p"] < alpha
+            if failed:
+                failures.append(f"dice.{name}.{test}")
+            print(f"  {test:8} chi2 {result[f'{test}_chi2']:>10}  p {result[f'{test}_p']:<8}{'  FAILED' if failed else ''}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the bot's handlers")
+    parser.add_argument("-w", "--workload", action="append", choices=list(WORKLOADS),
+                        help="workload to run (repeatable, default: all)")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply users and updates by this factor")
+    parser.add_argument("--concurrency", type=int, default=16, help="updates processed concurrently")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated Bot API round trip in seconds")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="write results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    parser.add_argument("--dice-rolls", type=int,
+                        help="dice rolls for the chi-square self-test (default 3000000 without -w, 0 to skip)")
+    parser.add_argument("--dice-alpha", type=float, default=0.001, help="self-test fails below this p-value")
+    parser.add_argument("--run-one", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run_one:
+        _run_one(args)
+        return
+
+    settings = {"scale": args.scale, "concurrency": args.concurrency, "latency": args.latency}
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            saved = json.load(f)
+        if saved.get("settings") == settings:
+            baseline = saved["results"]
+        else:
+            print(f"Baseline {args.baseline} was recorded with {saved.get('settings')}, not comparing")
+
+    results = {}
+    regressions = []
+    for name in args.workload or list(WORKLOADS):
+        print(f"== {name}: {WORKLOADS[name].description}")
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), "--run-one", name,
+                                 "--scale", str(args.scale), "--concurrency", str(args.concurrency),
+                                 "--latency", str(args.latency)],
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, check=True)
+        result = results[name] = json.loads(output.stdout.strip().splitlines()[-1])
+        print(f"  {result['updates']} updates, {result['users']} users: {result['updates_per_s']} updates/s, "
+              f"p50 {result['p50_ms']} ms, p99 {result['p99_ms']} ms")
+        print(f"  cold start: ready in {result['ready_ms']} ms, first update handled {result['first_update_ms']} ms later")
+        print(f"  per update: {result['queries_per_update']} queries, {result['commits_per_update']} commits, "
+              f"{result['api_calls_per_update']} API calls {result['api_calls']}")
+        if name in baseline:
+            regressions += [f"{name}.{metric}" for metric in _compare(name, result, baseline[name], args.tolerance)]
+
+    dice_rolls = args.dice_rolls if args.dice_rolls is not None else (0 if args.workload else 3000000)
+    failures = _dice_self_test(dice_rolls, args.dice_alpha) if dice_rolls > 0 else []
+
+    if args.save_baseline:
+        if os.path.exists(args.baseline):
+            with open(args.baseline, encoding="utf-8") as f:
+                saved = json.load(f)
+            if saved.get("settings") == settings:
+                results = {**saved["results"], **results}
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({"settings": settings, "machine": f"{platform.platform()} / Python {platform.python_version()}",
+                       "results": results}, f, indent=2, ensure_ascii=False)
+            f.write("\n")
+        print(f"Baseline written to {args.baseline}")
+    if regressions:
+        print(f"Regressions beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+    if failures:
+        print(f"Dice self-test failed (p < {args.dice_alpha}): {', '.join(failures)}")
+    if regressions or failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,25 @@
 import os
 import logging
 from telegram import Update, Dice, BotCommand
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-import random
-import sqlite3
-from datetime import datetime, timedelta
+from telegram.ext import Application, ChatMemberHandler, CommandHandler, MessageHandler, TypeHandler, filters, ContextTypes
+import time
+from datetime import datetime
+
+import metrics
+from activity import ActivityTracker
+from admins import AdminCache
+from dice import DiceService
+from achievements import ACHIEVEMENTS, AchievementEngine
+from games import BET_TYPES, mode_names
+from leaderboard import Leaderboard
+from ledger import LedgerMaintenance
+from ratelimit import FloodControl, OutgoingRateLimiter, parse_command_limits
+from replies import FastMode, ReplyBuilder
+from rounds import RoundManager
+from sharding import ShardRouter
+from startup import StartupTasks
+from storage import LEDGER_REASONS, InsufficientPoints, create_storage, points_log
+from webhook import run_webhook
 
 # 配置日志
 logging.basicConfig(
@@ -13,123 +28,111 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# 数据库初始化
-def init_db():
-    try:
-        conn = sqlite3.connect("points.db", check_same_thread=False)
-        c = conn.cursor()
-        c.execute("""CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            points INTEGER DEFAULT 0,
-            last_message TIMESTAMP,
-            consecutive_wins INTEGER DEFAULT 0
-        )""")
-        c.execute("""CREATE TABLE IF NOT EXISTS achievements (
-            user_id INTEGER,
-            achievement_name TEXT,
-            unlocked INTEGER DEFAULT 0,
-            progress INTEGER DEFAULT 0,
-            PRIMARY KEY (user_id, achievement_name)
-        )""")
-        conn.commit()
-        logger.info("Database initialized successfully")
-    except Exception as e:
-        logger.error(f"Failed to initialize database: {str(e)}")
-        raise
-    finally:
-        conn.close()
+# 数据库：DATABASE_URL 为 postgresql://... 时使用 PostgreSQL，否则为 SQLite 文件（WAL 模式，读写均在后台线程执行）
+DB_PATH = os.getenv("DB_PATH", "points.db")
+DATABASE_URL = os.getenv("DATABASE_URL") or DB_PATH
+storage = metrics.instrument_storage(create_storage(DATABASE_URL))
+# 积分变动日志：默认 DEBUG 级别（INFO 时不输出），POINTS_LOG_SAMPLE 为抽样比例
+points_log.configure(level=os.getenv("POINTS_LOG_LEVEL", "DEBUG"), sample=os.getenv("POINTS_LOG_SAMPLE", "1"))
+# 成就缓存最多保留 ACHIEVEMENT_CACHE_USERS 个最近活跃用户的解锁记录
+achievement_engine = AchievementEngine(storage, max_users=int(os.getenv("ACHIEVEMENT_CACHE_USERS", "100000")))
+# 群管理员缓存；ADMIN_IDS 为逗号分隔的固定管理员 user_id，私聊中只认这份名单
+admin_cache = AdminCache(ttl=float(os.getenv("ADMIN_CACHE_TTL", "300")),
+                         static_admins={int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()})
+# 入站限流（格式 "次数/秒数"）：每用户、每群、每命令
+flood_control = FloodControl(user=os.getenv("RATE_LIMIT_USER", "5/10"),
+                             chat=os.getenv("RATE_LIMIT_CHAT", "30/10"),
+                             commands=parse_command_limits(os.getenv("RATE_LIMIT_COMMANDS", "play=3/5,addallpoints=1/60")),
+                             max_backlog=float(os.getenv("OUTGOING_MAX_BACKLOG", "30")))
+# 多进程部署时各进程共享的群级缓存（排行榜、快速模式）的有效期，单进程时不设
+SHARED_CACHE_TTL = float(os.getenv("SHARED_CACHE_TTL")) if os.getenv("SHARED_CACHE_TTL") else None
+# 排行榜缓存
+leaderboard_cache = Leaderboard(storage, ttl=SHARED_CACHE_TTL)
+# 各群快速模式开关
+fast_mode = FastMode(storage, ttl=SHARED_CACHE_TTL)
+# 骰子随机数：DICE_RNG=system 使用系统 CSPRNG（默认），commit 为承诺-揭示模式（/fair 查看种子哈希，
+# 每 DICE_SEED_ROLLS 次开奖换种子并公布旧种子，种子保存在数据库中，重启后仍可核对）；DICE_BUFFER 为预生成结果的缓冲大小。
+# 多进程部署时每个工作进程（WORKER_INDEX）各自一条结果流
+dice_service = DiceService(mode=os.getenv("DICE_RNG", "system"), buffer_size=int(os.getenv("DICE_BUFFER", "4096")),
+                           rotate_after=int(os.getenv("DICE_SEED_ROLLS", "1000")), storage=storage,
+                           shard=int(os.getenv("WORKER_INDEX", "0")))
+# 群内下注轮次（/roundmode 开启后，本群 /play 合并到同一轮统一开奖）
+round_manager = RoundManager(storage, achievement_engine, fast_mode, dice_service, ttl=SHARED_CACHE_TTL)
+# 发言积分写回缓冲，每 ACTIVITY_FLUSH_INTERVAL 秒批量落盘
+activity_tracker = ActivityTracker(storage, achievement_engine,
+                                   flush_interval=float(os.getenv("ACTIVITY_FLUSH_INTERVAL", "5")))
+# 积分流水维护：每 LEDGER_SNAPSHOT_INTERVAL 秒增量快照余额，LEDGER_RETENTION_DAYS > 0 时清理快照前的旧流水
+ledger_maintenance = LedgerMaintenance(storage, interval=float(os.getenv("LEDGER_SNAPSHOT_INTERVAL", "3600")),
+                                       retention_days=int(os.getenv("LEDGER_RETENTION_DAYS", "0")))
+# 监控指标：设置 METRICS_PORT 后在 METRICS_HOST（默认仅本机）提供 /metrics
+metrics_server = metrics.MetricsServer(host=os.getenv("METRICS_HOST", "127.0.0.1"),
+                                       port=int(os.getenv("METRICS_PORT", "0"))) if os.getenv("METRICS_PORT") else None
+loop_lag_monitor = metrics.LoopLagMonitor()
+metrics.StatsCollector("bot_flood_control_total", "Inbound updates dropped by flood control", flood_control.stats)
+
+# 指令菜单
+BOT_COMMANDS = [
+    BotCommand("start", "开始使用，查看玩法"),
+    BotCommand("play", "参与游戏：和值、三同号、二同号、单骰、大小单双"),
+    BotCommand("balance", "查看积分"),
+    BotCommand("achievements", "查看成就"),
+    BotCommand("leaderboard", "查看排行榜：本群/global，可加页码"),
+    BotCommand("history", "查看积分流水"),
+    BotCommand("fair", "查看骰子随机数与种子哈希"),
+    BotCommand("addpoints", "管理员：为用户加分"),
+    BotCommand("addallpoints", "管理员：为所有人加分"),
+    BotCommand("fastmode", "快速模式：不显示骰子动画"),
+    BotCommand("roundmode", "轮次模式：本群下注每轮统一开奖")
+]
+# 启动后在后台同步指令菜单（未变化时跳过）并预热最近活跃的 WARMUP_CHATS 个群、WARMUP_USERS 个用户的缓存
+startup_tasks = StartupTasks(storage, BOT_COMMANDS, leaderboard_cache, fast_mode, round_manager, achievement_engine,
+                             admin_cache, chats=int(os.getenv("WARMUP_CHATS", "20")),
+                             users=int(os.getenv("WARMUP_USERS", "1000")))
 
 # 获取用户积分
-def get_points(user_id):
-    conn = sqlite3.connect("points.db", check_same_thread=False)
-    c = conn.cursor()
+async def get_points(user_id):
     try:
-        c.execute("SELECT points FROM users WHERE user_id = ?", (user_id,))
-        result = c.fetchone()
-        return result[0] if result else 0
+        return await storage.get_points(user_id)
     except Exception as e:
         logger.error(f"Error getting points for user {user_id}: {str(e)}")
         return 0
-    finally:
-        conn.close()
 
-# 更新积分
-def update_points(user_id, username, points_change):
-    conn = sqlite3.connect("points.db", check_same_thread=False)
-    c = conn.cursor()
+# 更新积分（reason / details 记入积分流水）
+async def update_points(user_id, username, points_change, reason="admin", details=None):
     try:
-        c.execute("INSERT OR REPLACE INTO users (user_id, username, points) VALUES (?, ?, COALESCE((SELECT points FROM users WHERE user_id = ?) + ?, ?))",
-                  (user_id, username, user_id, points_change, points_change))
-        conn.commit()
-        check_achievements(user_id, "points")
-        logger.info(f"Updated points for user {user_id}: {points_change}")
+        points = await storage.update_points(user_id, username, points_change, reason, details)
     except Exception as e:
         logger.error(f"Error updating points for user {user_id}: {str(e)}")
-    finally:
-        conn.close()
-
-# 检查成就
-def check_achievements(user_id, trigger_type):
-    conn = sqlite3.connect("points.db", check_same_thread=False)
-    c = conn.cursor()
-    achievements = [
-        ("新手玩家", lambda: trigger_type == "play", 10),
-        ("连胜大师", lambda: c.execute("SELECT consecutive_wins FROM users WHERE user_id = ?", (user_id,)).fetchone()[0] >= 3, 50),
-        ("积分达人", lambda: get_points(user_id) >= 100, 20),
-        ("活跃分子", lambda: c.execute("SELECT progress FROM achievements WHERE user_id = ? AND achievement_name = ?", (user_id, "活跃分子")).fetchone()[0] >= 50, 30),
-        ("大赢家", lambda: trigger_type == "big_win", 40)
-    ]
-    messages = []
+        return []
+    return await check_achievements(user_id, ("points",), {"points": points})
+
+# 检查成就（只评估订阅了这些事件且尚未解锁的规则）
+async def check_achievements(user_id, triggers, facts):
     try:
-        for name, condition, reward in achievements:
-            c.execute("SELECT unlocked FROM achievements WHERE user_id = ? AND achievement_name = ?", (user_id, name))
-            if c.fetchone() is None:
-                c.execute("INSERT INTO achievements (user_id, achievement_name, progress) VALUES (?, ?, 0)", (user_id, name))
-            c.execute("SELECT unlocked FROM achievements WHERE user_id = ? AND achievement_name = ?", (user_id, name))
-            if c.fetchone()[0] == 0 and condition():
-                c.execute("UPDATE achievements SET unlocked = 1 WHERE user_id = ? AND achievement_name = ?", (user_id, name))
-                update_points(user_id, None, reward)
-                messages.append(f"🎉 恭喜解锁成就：{name}！奖励 {reward} 积分！")
-        conn.commit()
+        return await achievement_engine.check(user_id, triggers, facts)
     except Exception as e:
         logger.error(f"Error checking achievements for user {user_id}: {str(e)}")
-    finally:
-        conn.close()
-    return messages
+        return []
 
-# 检查管理员
+# 检查管理员（管理员列表按群缓存）
 async def is_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     try:
-        user_id = update.effective_user.id
-        chat_id = update.effective_chat.id
-        admins = await context.bot.get_chat_administrators(chat_id)
-        return any(admin.user.id == user_id for admin in admins)
+        return await admin_cache.is_admin(context.bot, update.effective_chat, update.effective_user.id)
     except Exception as e:
         logger.error(f"Error checking admin status: {str(e)}")
         await update.message.reply_text(f"检查管理员权限失败：{str(e)}")
         return False
 
-# 设置指令菜单
-async def set_bot_commands(application: Application):
-    try:
-        commands = [
-            BotCommand("start", "开始使用，查看玩法"),
-            BotCommand("play", "参与游戏：和值、三同号、二同号、单骰、大小单双"),
-            BotCommand("balance", "查看积分"),
-            BotCommand("achievements", "查看成就"),
-            BotCommand("leaderboard", "查看排行榜"),
-            BotCommand("addpoints", "管理员：为用户加分"),
-            BotCommand("addallpoints", "管理员：为所有人加分")
-        ]
-        await application.bot.set_my_commands(commands)
-        logger.info("Bot commands set successfully")
-    except Exception as e:
-        logger.error(f"Error setting bot commands: {str(e)}")
+# 群聊 ID（私聊返回 None），用于分群排行榜
+def group_chat_id(update: Update):
+    chat = update.effective_chat
+    if chat is None or chat.type == "private":
+        return None
+    return chat.id
 
 # 启动命令
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("欢迎体验分分彩机器人！点击菜单（📋）查看玩法：\n/play sum 4~17 [积分] 猜总和\n/play triple 1~6/any [积分] 三同号\n/play pair X-X-Y/any [积分] 二同号\n/play single 1~6 [积分] 猜点数\n/play size big/small [积分] 总和大小\n/play parity odd/even [积分] 总和单双\n/balance 查看积分\n/achievements 查看成就\n/leaderboard 排行榜\n/addpoints @用户名 [积分] 管理员加分\n/addallpoints [积分] 给所有人加分")
+    await update.message.reply_text("欢迎体验分分彩机器人！点击菜单（📋）查看玩法：\n/play sum 4~17 [积分] 猜总和\n/play triple 1~6/any [积分] 三同号\n/play pair X-X-Y/any [积分] 二同号\n/play single 1~6 [积分] 猜点数\n/play size big/small [积分] 总和大小\n/play parity odd/even [积分] 总和单双\n/balance 查看积分\n/achievements 查看成就\n/leaderboard [global] [页码] 排行榜\n/history [页码] 积分流水\n/fair 骰子公平性验证\n/addpoints @用户名 [积分] 管理员加分\n/addallpoints [积分] 给所有人加分\n/fastmode on/off 快速模式（不显示骰子动画）\n/roundmode 秒数/off 轮次模式（每轮统一开奖）")
 
 # 发言加积分
 async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -137,23 +140,14 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     user_id = update.effective_user.id
     username = update.effective_user.username or update.effective_user.first_name
-    conn = sqlite3.connect("points.db", check_same_thread=False)
-    c = conn.cursor()
     try:
-        c.execute("SELECT last_message FROM users WHERE user_id = ?", (user_id,))
-        last_message = c.fetchone()
-        now = datetime.now()
-        if not last_message or (now - datetime.fromisoformat(last_message[0])).total_seconds() > 60:
-            update_points(user_id, username, 1)
-            c.execute("UPDATE users SET last_message = ? WHERE user_id = ?", (now.isoformat(), user_id))
-            c.execute("UPDATE achievements SET progress = progress + 1 WHERE user_id = ? AND achievement_name = ?", (user_id, "活跃分子"))
-            conn.commit()
-            for msg in check_achievements(user_id, "message"):
-                await update.message.reply_text(msg)
+        facts = await activity_tracker.record(user_id, username, datetime.now(), group_chat_id(update))
+        if facts is None:
+            return
+        for msg in await check_achievements(user_id, ("message",), facts):
+            await update.message.reply_text(msg)
     except Exception as e:
         logger.error(f"Error in message handler for user {user_id}: {str(e)}")
-    finally:
-        conn.close()
 
 # 分分彩游戏（3个骰子）
 async def play(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -162,8 +156,15 @@ async def play(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(args) != 3:
         await update.message.reply_text("格式：/play [玩法] [参数] [积分]\n示例：/play sum 4 10 或 /play triple 6 10")
         return
-    mode = args[0].lower()
-    bet = args[1].lower()
+    bet_type = BET_TYPES.get(args[0].lower())
+    if bet_type is None:
+        await update.message.reply_text(f"玩法错误！请用 {mode_names()}。")
+        return
+    try:
+        selection = bet_type.parse(args[1].lower())
+    except ValueError:
+        await update.message.reply_text(bet_type.error)
+        return
     try:
         points = int(args[2])
         if points <= 0:
@@ -171,205 +172,130 @@ async def play(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except ValueError:
         await update.message.reply_text("积分需为正整数！")
         return
-    current_points = get_points(user_id)
+    chat_id = group_chat_id(update)
+    try:
+        round_seconds = await round_manager.seconds(chat_id) if chat_id is not None else 0
+        if round_seconds:
+            notice = await round_manager.place(update.message, update.effective_user, bet_type, selection, points,
+                                               round_seconds, label=" ".join(args).lower())
+            if notice:
+                await update.message.reply_text(notice)
+            return
+    except Exception as e:
+        logger.error(f"Error joining round for user {user_id}: {str(e)}")
+        await update.message.reply_text("下注失败，请稍后重试！")
+        return
+    current_points = await get_points(user_id)
     if points > current_points:
         await update.message.reply_text("积分不足！")
         return
 
-    # 生成3个骰子
-    dice1 = random.randint(1, 6)
-    dice2 = random.randint(1, 6)
-    dice3 = random.randint(1, 6)
-    total = dice1 + dice2 + dice3
-    result = [dice1, dice2, dice3]
-    # 发送3个骰子动画
-    try:
-        await update.message.reply_dice(emoji="🎲")
-        await update.message.reply_dice(emoji="🎲")
-        await update.message.reply_dice(emoji="🎲")
-    except Exception as e:
-        logger.error(f"Error sending dice: {str(e)}")
+    # 生成3个骰子；骰子动画与结算并发进行，文字结果合并为一条消息
+    draw = await dice_service.roll(update.effective_chat.id)
+    dice = draw.dice
+    # 承诺-揭示模式下附上种子哈希前缀和 nonce，便于换种子后核对
+    proof = f" {draw.commitment[:8]}#{draw.nonce}" if draw.nonce is not None else ""
+    reply = ReplyBuilder(update.message)
+    if not await fast_mode.enabled(update.effective_chat.id):
+        reply.dice(3)
 
-    update_points(user_id, update.effective_user.username, -points)
-    conn = sqlite3.connect("points.db", check_same_thread=False)
-    c = conn.cursor()
-    
     try:
-        if mode == "size":
-            if bet not in ["big", "small"]:
-                await update.message.reply_text("请猜 big 或 small！")
-                return
-            is_big = total >= 11
-            result_str = "big" if is_big else "small"
-            await update.message.reply_text(f"🎲 结果：{dice1}-{dice2}-{dice3} (总和 {total})，{'大' if is_big else '小'}")
-            if bet == result_str:
-                winnings = int(points * 1.8)
-                update_points(user_id, update.effective_user.username, winnings)
-                await update.message.reply_text(f"🎉 猜对！赢得 {winnings} 积分！")
-                if winnings >= 500:
-                    check_achievements(user_id, "big_win")
-            else:
-                await update.message.reply_text(f"😅 猜错！扣除 {points} 积分。")
-        
-        elif mode == "parity":
-            if bet not in ["odd", "even"]:
-                await update.message.reply_text("请猜 odd 或 even！")
-                return
-            is_even = total % 2 == 0
-            result_str = "even" if is_even else "odd"
-            await update.message.reply_text(f"🎲 结果：{dice1}-{dice2}-{dice3} (总和 {total})，{'双' if is_even else '单'}")
-            if bet == result_str:
-                winnings = int(points * 1.8)
-                update_points(user_id, update.effective_user.username, winnings)
-                await update.message.reply_text(f"🎉 猜对！赢得 {winnings} 积分！")
-                if winnings >= 500:
-                    check_achievements(user_id, "big_win")
-            else:
-                await update.message.reply_text(f"😅 猜错！扣除 {points} 积分。")
-        
-        elif mode == "sum":
-            try:
-                bet_sum = int(bet)
-                if bet_sum < 3 or bet_sum > 18:
-                    raise ValueError
-            except ValueError:
-                await update.message.reply_text("总和需为 3-18 的整数！")
-                return
-            await update.message.reply_text(f"🎲 结果：{dice1}-{dice2}-{dice3} (总和 {total})")
-            if bet_sum == total:
-                odds = {4: 50, 17: 50, 5: 18, 16: 18, 6: 14, 15: 14, 7: 12, 14: 12, 8: 8, 13: 8, 9: 6, 12: 6, 10: 6, 11: 6}
-                winnings = points * odds.get(total, 6)
-                update_points(user_id, update.effective_user.username, winnings)
-                await update.message.reply_text(f"🎉 猜对总和！赢得 {winnings} 积分！")
-                if winnings >= 500:
-                    check_achievements(user_id, "big_win")
-            else:
-                await update.message.reply_text(f"😅 猜错！扣除 {points} 积分。")
-        
-        elif mode == "triple":
-            is_triple = dice1 == dice2 == dice3
-            await update.message.reply_text(f"🎲 结果：{dice1}-{dice2}-{dice3}")
-            if bet == "any":
-                if is_triple:
-                    winnings = points * 30
-                    update_points(user_id, update.effective_user.username, winnings)
-                    await update.message.reply_text(f"🎉 三同号通选中奖！赢得 {winnings} 积分！")
-                    if winnings >= 500:
-                        check_achievements(user_id, "big_win")
-                else:
-                    await update.message.reply_text(f"😅 未开豹子！扣除 {points} 积分。")
-            else:
-                try:
-                    bet_num = int(bet)
-                    if bet_num < 1 or bet_num > 6:
-                        raise ValueError
-                except ValueError:
-                    await update.message.reply_text("三同号需为 1-6 或 any！")
-                    return
-                if is_triple and dice1 == bet_num:
-                    winnings = points * 150
-                    update_points(user_id, update.effective_user.username, winnings)
-                    c.execute("UPDATE users SET consecutive_wins = consecutive_wins + 1 WHERE user_id = ?", (user_id,))
-                    await update.message.reply_text(f"🎉 三同号单选中奖！赢得 {winnings} 积分！")
-                    if winnings >= 500:
-                        check_achievements(user_id, "big_win")
-                else:
-                    c.execute("UPDATE users SET consecutive_wins = 0 WHERE user_id = ?", (user_id,))
-                    await update.message.reply_text(f"😅 未中！扣除 {points} 积分。")
-        
-        elif mode == "pair":
-            await update.message.reply_text(f"🎲 结果：{dice1}-{dice2}-{dice3}")
-            if bet == "any":
-                if len(set(result)) == 2:
-                    winnings = points * 5
-                    update_points(user_id, update.effective_user.username, winnings)
-                    await update.message.reply_text(f"🎉 二同号复选中奖！赢得 {winnings} 积分！")
-                    if winnings >= 500:
-                        check_achievements(user_id, "big_win")
-                else:
-                    await update.message.reply_text(f"😅 未开对子！扣除 {points} 积分。")
-            else:
-                try:
-                    bet_numbers = [int(x) for x in bet.split("-")]
-                    if len(bet_numbers) != 3 or not all(1 <= x <= 6 for x in bet_numbers):
-                        raise ValueError
-                except ValueError:
-                    await update.message.reply_text("二同号需为 X-X-Y 格式，如 1-1-2！")
-                    return
-                sorted_bet = sorted(bet_numbers)
-                sorted_result = sorted(result)
-                if sorted_bet == sorted_result and len(set(bet_numbers)) == 2:
-                    winnings = points * 25
-                    update_points(user_id, update.effective_user.username, winnings)
-                    c.execute("UPDATE users SET consecutive_wins = consecutive_wins + 1 WHERE user_id = ?", (user_id,))
-                    await update.message.reply_text(f"🎉 二同号单选中奖！赢得 {winnings} 积分！")
-                    if winnings
-
- >= 500:
-                        check_achievements(user_id, "big_win")
-                else:
-                    c.execute("UPDATE users SET consecutive_wins = 0 WHERE user_id = ?", (user_id,))
-                    await update.message.reply_text(f"😅 未中！扣除 {points} 积分。")
-        
-        elif mode == "single":
-            try:
-                bet_num = int(bet)
-                if bet_num < 1 or bet_num > 6:
-                    raise ValueError
-            except ValueError:
-                await update.message.reply_text("猜点数需为 1-6 的整数！")
-                return
-            count = result.count(bet_num)
-            await update.message.reply_text(f"🎲 结果：{dice1}-{dice2}-{dice3}")
-            if count > 0:
-                winnings = points * count
-                update_points(user_id, update.effective_user.username, winnings)
-                await update.message.reply_text(f"🎉 猜中 {count} 次！赢得 {winnings} 积分！")
-                if winnings >= 500:
-                    check_achievements(user_id, "big_win")
-            else:
-                await update.message.reply_text(f"😅 未猜中！扣除 {points} 积分。")
-        
-        else:
-            await update.message.reply_text("玩法错误！请用 size, parity, sum, triple, pair 或 single。")
+        winnings = bet_type.payout(selection, dice, points)
+        streak = (winnings > 0) if bet_type.tracks_streak(selection) else None
+        try:
+            balance, consecutive_wins = await storage.settle_bet(user_id, update.effective_user.username, points,
+                                                                 winnings, streak=streak, chat_id=chat_id,
+                                                                 details=f"{' '.join(args).lower()} 开 "
+                                                                         f"{dice[0]}-{dice[1]}-{dice[2]}{proof}")
+        except InsufficientPoints:
+            await reply.add("积分不足！").send()
             return
-        
-        conn.commit()
-        await update.message.reply_text(f"当前积分：{get_points(user_id)}")
-        for msg in check_achievements(user_id, "play"):
-            await update.message.reply_text(msg)
-    
+        reply.add(bet_type.result_text(dice) + proof)
+        if winnings > 0:
+            reply.add(bet_type.win_text(selection, dice, winnings))
+        else:
+            reply.add(bet_type.lose_text(selection, points))
+        triggers = ("play", "points", "big_win") if winnings >= 500 else ("play", "points")
+        messages = await check_achievements(user_id, triggers, {"points": balance, "consecutive_wins": consecutive_wins})
+        reply.add(f"当前积分：{balance}")
+        for msg in messages:
+            reply.add(msg)
+        await reply.send()
+
     except Exception as e:
         logger.error(f"Error in play handler for user {user_id}: {str(e)}")
-        await update.message.reply_text("游戏发生错误，请稍后重试！")
-    finally:
-        conn.close()
+        await reply.clear().add("游戏发生错误，请稍后重试！").send()
+
+# 快速模式：/fastmode on|off，开启后本群 /play 不再发送骰子动画（群内仅管理员可切换）
+async def fastmode(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    args = context.args
+    if len(args) != 1 or args[0].lower() not in ("on", "off"):
+        enabled = await fast_mode.enabled(update.effective_chat.id)
+        await update.message.reply_text(f"快速模式：{'开启' if enabled else '关闭'}\n格式：/fastmode on 或 /fastmode off")
+        return
+    if group_chat_id(update) is not None and not await is_admin(update, context):
+        await update.message.reply_text("仅管理员可使用此命令！")
+        return
+    enabled = args[0].lower() == "on"
+    try:
+        await fast_mode.set(update.effective_chat.id, enabled)
+        await update.message.reply_text(f"快速模式已{'开启' if enabled else '关闭'}！")
+    except Exception as e:
+        logger.error(f"Error in fastmode handler: {str(e)}")
+        await update.message.reply_text("设置失败，请稍后重试！")
+
+# 轮次模式：/roundmode 秒数 开启（本群下注每轮统一开奖），/roundmode off 关闭；仅群内管理员可切换
+async def roundmode(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = group_chat_id(update)
+    if chat_id is None:
+        await update.message.reply_text("轮次模式仅在群内可用！")
+        return
+    if not round_manager.enabled:
+        await update.message.reply_text("多进程部署（WORKERS > 1）时不支持轮次模式，下注将立即开奖！")
+        return
+    args = context.args
+    if len(args) != 1:
+        seconds = await round_manager.seconds(chat_id)
+        status = f"开启，每轮 {seconds} 秒" if seconds else "关闭"
+        await update.message.reply_text(f"轮次模式：{status}\n格式：/roundmode 秒数（5-300）或 /roundmode off")
+        return
+    if not await is_admin(update, context):
+        await update.message.reply_text("仅管理员可使用此命令！")
+        return
+    try:
+        seconds = 0 if args[0].lower() == "off" else int(args[0])
+        if seconds and not 5 <= seconds <= 300:
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text("轮次时长需为 5-300 的整数秒，或 off！")
+        return
+    try:
+        await round_manager.set_seconds(chat_id, seconds)
+        await update.message.reply_text(f"轮次模式已开启，每轮 {seconds} 秒！" if seconds else "轮次模式已关闭！")
+    except Exception as e:
+        logger.error(f"Error in roundmode handler: {str(e)}")
+        await update.message.reply_text("设置失败，请稍后重试！")
 
 # 查看积分
 async def balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    points = get_points(update.effective_user.id)
+    points = await get_points(update.effective_user.id)
     await update.message.reply_text(f"你的积分：{points}")
 
 # 查看成就
 async def achievements(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    conn = sqlite3.connect("points.db", check_same_thread=False)
-    c = conn.cursor()
     try:
-        c.execute("SELECT achievement_name, unlocked FROM achievements WHERE user_id = ?", (user_id,))
-        ach_list = c.fetchall()
-        if not ach_list:
+        unlocked = await achievement_engine.unlocked(user_id)
+        if not unlocked:
             await update.message.reply_text("你还没有成就，快去玩游戏解锁吧！")
             return
         message = "🏅 你的成就：\n"
-        for name, unlocked in ach_list:
-            message += f"{name}: {'已解锁' if unlocked else '未解锁'}\n"
+        for rule in ACHIEVEMENTS:
+            message += f"{rule.name}: {'已解锁' if rule.name in unlocked else '未解锁'}\n"
         await update.message.reply_text(message)
     except Exception as e:
         logger.error(f"Error in achievements handler for user {user_id}: {str(e)}")
         await update.message.reply_text("查询成就失败，请稍后重试！")
-    finally:
-        conn.close()
 
 # 管理员给单一用户加分
 async def add_points(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -388,21 +314,16 @@ async def add_points(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("积分需为0-1000的整数！")
         return
     username = args[0][1:]
-    conn = sqlite3.connect("points.db", check_same_thread=False)
-    c = conn.cursor()
     try:
-        c.execute("SELECT user_id FROM users WHERE username = ?", (username,))
-        user = c.fetchone()
-        if not user:
+        user_id = await storage.find_user_by_username(username)
+        if user_id is None:
             await update.message.reply_text(f"用户 @{username} 不存在！请确认用户已发言或参与游戏。")
             return
-        update_points(user[0], username, points)
+        await update_points(user_id, username, points, details=f"管理员 {update.effective_user.id}")
         await update.message.reply_text(f"已为 @{username} 添加 {points} 积分！")
     except Exception as e:
         logger.error(f"Error in add_points handler: {str(e)}")
         await update.message.reply_text("加分失败，请稍后重试！")
-    finally:
-        conn.close()
 
 # 管理员给所有人加分
 async def add_all_points(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -415,81 +336,254 @@ async def add_all_points(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     try:
         points = int(args[0])
-        if points > 1000 or points < 0:
+        if points > 1000 or points < 1:
             raise ValueError
     except ValueError:
-        await update.message.reply_text("积分需为0-1000的整数！")
+        await update.message.reply_text("积分需为1-1000的整数！")
         return
-    conn = sqlite3.connect("points.db", check_same_thread=False)
-    c = conn.cursor()
     try:
-        c.execute("SELECT user_id, username FROM users")
-        users = c.fetchall()
-        if not users:
-            await update.message.reply_text("暂无用户记录！")
+        started = time.monotonic()
+        progress = await update.message.reply_text("正在为所有用户加分…")
+        thresholds = [(rule.name, rule.reward, rule.min_points) for rule in achievement_engine.threshold_rules()]
+        count, unlocked = await storage.grant_all(points, thresholds)
+        if not count:
+            await progress.edit_text("暂无用户记录！")
             return
-        for user_id, username in users:
-            update_points(user_id, username, points)
-        await update.message.reply_text(f"已为所有 {len(users)} 名用户各添加 {points} 积分！")
+        text = f"已为所有 {count} 名用户各添加 {points} 积分！"
+        for name, user_ids in unlocked.items():
+            achievement_engine.mark_unlocked(name, user_ids)
+            if user_ids:
+                text += f"\n{len(user_ids)} 名用户解锁成就：{name}"
+        await progress.edit_text(f"{text}\n耗时 {time.monotonic() - started:.2f} 秒")
     except Exception as e:
         logger.error(f"Error in add_all_points handler: {str(e)}")
         await update.message.reply_text("加分失败，请稍后重试！")
-    finally:
-        conn.close()
 
-# 排行榜
+# 排行榜：群里默认显示本群榜，/leaderboard global 显示全局榜，末尾数字为页码
 async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    conn = sqlite3.connect("points.db", check_same_thread=False)
-    c = conn.cursor()
+    args = list(context.args)
+    chat_id = group_chat_id(update)
+    if args and args[0].lower() == "global":
+        chat_id = None
+        args.pop(0)
     try:
-        c.execute("SELECT username, points FROM users ORDER BY points DESC LIMIT 5")
-        top_users = c.fetchall()
+        page = int(args[0]) if args else 1
+        if page < 1 or len(args) > 1:
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text("格式：/leaderboard [global] [页码]\n示例：/leaderboard 2")
+        return
+    try:
+        top_users = await leaderboard_cache.page(page, chat_id)
         if not top_users:
             await update.message.reply_text("暂无排行数据！")
             return
-        message = "🏆 积分排行榜 🏆\n"
-        for i, (username, points) in enumerate(top_users, 1):
-            message += f"{i}. @{username}: {points} 积分\n"
+        title = "积分排行榜" if chat_id is None else "本群积分排行榜"
+        message = f"🏆 {title} 🏆（第 {page} 页）\n"
+        for rank, username, points in top_users:
+            message += f"{rank}. @{username}: {points} 积分\n"
+        own = await leaderboard_cache.rank(update.effective_user.id, chat_id)
+        if own:
+            message += f"你的排名：第 {own[0]} 名（{own[1]} 积分）"
         await update.message.reply_text(message)
     except Exception as e:
         logger.error(f"Error in leaderboard handler: {str(e)}")
         await update.message.reply_text("查询排行榜失败，请稍后重试！")
-    finally:
-        conn.close()
+
+# 积分流水：/history [页码] 查看自己的记录，管理员可用 /history @用户名 [页码] 查询他人
+async def history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    args = list(context.args)
+    user_id = update.effective_user.id
+    username = None
+    if args and args[0].startswith("@"):
+        if not await is_admin(update, context):
+            await update.message.reply_text("仅管理员可查询他人流水！")
+            return
+        username = args.pop(0)[1:]
+    try:
+        page = int(args[0]) if args else 1
+        if page < 1 or len(args) > 1:
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text("格式：/history [@用户名] [页码]\n示例：/history 2")
+        return
+    try:
+        if username is not None:
+            user_id = await storage.find_user_by_username(username)
+            if user_id is None:
+                await update.message.reply_text(f"用户 @{username} 不存在！")
+                return
+        entries = await storage.history(user_id, 10, (page - 1) * 10)
+        if not entries:
+            await update.message.reply_text("暂无积分记录！")
+            return
+        message = f"📜 {'@' + username if username else '你'}的积分流水（第 {page} 页）\n"
+        for created_at, delta, points, reason, details in entries:
+            message += f"{created_at.replace('T', ' ')} {LEDGER_REASONS.get(reason, reason)}"
+            if details:
+                message += f"（{details}）"
+            message += f" {delta:+d}，余额 {points}\n"
+        await update.message.reply_text(message)
+    except Exception as e:
+        logger.error(f"Error in history handler: {str(e)}")
+        await update.message.reply_text("查询流水失败，请稍后重试！")
+
+# 骰子公平性：承诺-揭示模式下显示本聊天当前种子哈希和上一个已公布的种子
+async def fair(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if dice_service.mode != "commit":
+        await update.message.reply_text("🔐 骰子由系统安全随机数（os.urandom）生成。")
+        return
+    streams = await dice_service.status(update.effective_chat.id)
+    message = ""
+    for shard, commitment, drawn, revealed in streams:
+        # 多进程部署时每个工作进程一条结果流，开奖结果中的哈希前缀表明所属的结果流
+        prefix = f"[结果流 {shard}] " if len(streams) > 1 else ""
+        if commitment:
+            message += f"🔐 {prefix}当前种子哈希：{commitment}\n"
+            if drawn is not None:
+                message += f"已开奖 {drawn} 次\n"
+        if revealed:
+            seed, previous, rolls = revealed
+            count = f"共开奖 {rolls} 次" if rolls is not None else "开奖次数未记录"
+            message += f"{prefix}上一个种子：{seed}\n（哈希 {previous}，{count}）\n"
+    message += f"每 {dice_service.rotate_after} 次开奖更换种子并公布，重启时也会公布\n"
+    message += "验证：SHA-256(种子) 应等于开奖前公布的哈希；结果中的 #n 表示第 n 次开奖，" \
+               "点数为 HMAC-SHA256(种子, \"n\") 中依次取小于 252 的字节 b，计算 b % 6 + 1"
+    await update.message.reply_text(message)
+
+# 启动：在 Application 的事件循环内迁移数据库并启动后台任务；指令菜单和缓存预热在后台进行，不推迟接收更新
+async def on_startup(application: Application, menu=True):
+    await storage.start()
+    await storage.migrate()
+    activity_tracker.start()
+    ledger_maintenance.start()
+    loop_lag_monitor.start()
+    if metrics_server is not None:
+        await metrics_server.start()
+    startup_tasks.start(application.bot, menu=menu)
+    metrics.startup_phase("ready")
+
+# 多进程部署的工作进程：指令菜单由前端进程同步
+async def on_worker_startup(application: Application):
+    await on_startup(application, menu=False)
+
+# 多进程部署的前端进程：启动工作进程前完成迁移，并在后台同步指令菜单
+async def on_front_startup(application: Application):
+    await storage.start()
+    await storage.migrate()
+    startup_tasks.start(application.bot, warm=False)
+
+async def on_front_shutdown(application: Application):
+    await startup_tasks.stop()
+    await storage.close()
+
+# 记录启动后收到第一条更新的时间
+async def first_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    metrics.startup_phase("first_update")
+
+# 停止接收更新后、Bot 关闭前立即开奖进行中的轮次
+async def on_stop(application: Application):
+    try:
+        await round_manager.close_all()
+    except Exception as e:
+        logger.error(f"Error closing betting rounds on shutdown: {str(e)}")
+
+# 写回缓冲区并关闭数据库连接池
+async def on_shutdown(application: Application):
+    await startup_tasks.stop()
+    try:
+        await activity_tracker.stop()
+    except Exception as e:
+        logger.error(f"Error flushing chat activity on shutdown: {str(e)}")
+    await ledger_maintenance.stop()
+    await loop_lag_monitor.stop()
+    if metrics_server is not None:
+        await metrics_server.stop()
+    try:
+        await dice_service.close()
+    except Exception as e:
+        logger.error(f"Error revealing dice seeds on shutdown: {str(e)}")
+    await storage.close()
+
+# 群成员变动（升降管理员）时更新管理员缓存
+async def chat_member_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    admin_cache.on_member_update(update.chat_member or update.my_chat_member)
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.error(f"Update {update} caused error: {context.error}")
     if update and update.message:
         await update.message.reply_text("发生错误，请稍后重试！")
 
+# 构建 Application 并注册处理器；request 用于替换 HTTP 请求层（离线测试），worker 为多进程部署的工作进程
+def build_application(token, request=None, worker=False):
+    # 出站请求排队限流，遇到 429 自动等待重试
+    rate_limiter = OutgoingRateLimiter(overall=os.getenv("RATE_LIMIT_OUTGOING", "30/1"),
+                                       group=os.getenv("RATE_LIMIT_GROUP_CHAT", "20/60"),
+                                       private=os.getenv("RATE_LIMIT_PRIVATE_CHAT", "3/1"))
+    metrics.StatsCollector("bot_outgoing_rate_limiter_total", "Outgoing requests queued or retried",
+                           rate_limiter.stats)
+    # 出站排队超过 OUTGOING_MAX_BACKLOG 秒的会话，入站限流直接丢弃其新命令
+    flood_control.outgoing = rate_limiter
+    # 轮次状态在进程内存中，而工作进程按用户分发更新，同一群会在多个进程各自开局
+    round_manager.enabled = not worker
+    # 同时处理的更新数；各处理器的共享状态都是并发安全的（写操作串行在存储写线程，余额由条件 UPDATE 保护）。
+    # 发送在出站限流中排队时处理器会等待，默认并发处理，避免一个群的排队阻塞其他会话
+    builder = Application.builder().token(token).rate_limiter(rate_limiter) \
+        .concurrent_updates(int(os.getenv("CONCURRENT_UPDATES", "64"))) \
+        .post_init(on_worker_startup if worker else on_startup).post_stop(on_stop).post_shutdown(on_shutdown)
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    app = builder.build()
+
+    app.add_handler(TypeHandler(Update, first_update), group=-2)
+    # 入站限流先于所有处理器执行
+    app.add_handler(TypeHandler(Update, flood_control.handle), group=-1)
+    app.add_handler(CommandHandler("start", metrics.track_handler(start)))
+    app.add_handler(CommandHandler("play", metrics.track_handler(play)))
+    app.add_handler(CommandHandler("balance", metrics.track_handler(balance)))
+    app.add_handler(CommandHandler("achievements", metrics.track_handler(achievements)))
+    app.add_handler(CommandHandler("addpoints", metrics.track_handler(add_points)))
+    app.add_handler(CommandHandler("addallpoints", metrics.track_handler(add_all_points)))
+    app.add_handler(CommandHandler("leaderboard", metrics.track_handler(leaderboard)))
+    app.add_handler(CommandHandler("history", metrics.track_handler(history)))
+    app.add_handler(CommandHandler("fair", metrics.track_handler(fair)))
+    app.add_handler(CommandHandler("fastmode", metrics.track_handler(fastmode)))
+    app.add_handler(CommandHandler("roundmode", metrics.track_handler(roundmode)))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, metrics.track_handler(message_handler)))
+    app.add_handler(ChatMemberHandler(chat_member_handler, ChatMemberHandler.ANY_CHAT_MEMBER))
+    app.add_error_handler(error_handler)
+    return app
+
 def main():
     try:
-        init_db()
         # 获取 Token，优先从环境变量
         token = os.getenv("BOT_TOKEN") or "8137040207:AAH_MLmXOol3sQLNmOgfnabrywb4clZaVLg"
         if token == "YOUR_BOT_TOKEN":
             logger.error("Bot token not set. Please set BOT_TOKEN environment variable or update bot.py")
             raise ValueError("Invalid bot token")
         
-        app = Application.builder().token(token).build()
-        
-        # 设置指令菜单
-        app.add_handler(CommandHandler("start", start))
-        app.add_handler(CommandHandler("play", play))
-        app.add_handler(CommandHandler("balance", balance))
-        app.add_handler(CommandHandler("achievements", achievements))
-        app.add_handler(CommandHandler("addpoints", add_points))
-        app.add_handler(CommandHandler("addallpoints", add_all_points))
-        app.add_handler(CommandHandler("leaderboard", leaderboard))
-        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
-        app.add_error_handler(error_handler)
-        
-        # 异步设置命令菜单
-        import asyncio
-        asyncio.run(set_bot_commands(app))
+        # WORKERS > 1 时本进程只接收更新，按用户分发给多个工作进程处理
+        workers = int(os.getenv("WORKERS", "1"))
+        if workers > 1:
+            app = ShardRouter(token, workers).build_front_application(post_init=on_front_startup,
+                                                                      post_shutdown=on_front_shutdown)
+        else:
+            app = build_application(token)
         
-        logger.info("Starting bot polling...")
-        app.run_polling()
+        # BOT_MODE=webhook 时以 webhook 方式运行，否则长轮询
+        if os.getenv("BOT_MODE", "polling") == "webhook":
+            logger.info("Starting bot webhook...")
+            run_webhook(app,
+                        listen=os.getenv("WEBHOOK_LISTEN", "0.0.0.0"),
+                        port=int(os.getenv("WEBHOOK_PORT", "8443")),
+                        url_path=os.getenv("WEBHOOK_PATH", ""),
+                        webhook_url=os.getenv("WEBHOOK_URL"),
+                        secret_token=os.getenv("WEBHOOK_SECRET"),
+                        drain_timeout=float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "30")))
+        else:
+            logger.info("Starting bot polling...")
+            # chat_member 更新默认不会推送，需要显式订阅
+            app.run_polling(allowed_updates=Update.ALL_TYPES)
     
     except Exception as e:
         logger.error(f"Failed to start bot: {str(e)}")
@@ -0,0 +1,222 @@
+import asyncio
+import hashlib
+import hmac
+import math
+import os
+import threading
+import time
+from collections import Counter, deque
+
+import metrics
+from games import OUTCOMES, outcome_index
+
+# 随机字节 -> 骰子点数：0~251 映射为 b % 6 + 1，252~255 丢弃（拒绝采样，保证六个点数等概率）
+FACES = bytes(b % 6 + 1 for b in range(256))
+REJECT = bytes(range(252, 256))
+
+
+def faces(data):
+    return data.translate(FACES, REJECT)
+
+
+# 承诺-揭示模式下第 nonce 次开奖的结果：HMAC-SHA256(种子, "nonce") 依次取未丢弃的字节；
+# 不足 3 个时（概率可忽略）继续用 "nonce:1"、"nonce:2"……
+def seeded_roll(seed, nonce):
+    values = faces(hmac.new(seed, str(nonce).encode(), hashlib.sha256).digest())
+    extra = 0
+    while len(values) < 3:
+        extra += 1
+        values += faces(hmac.new(seed, f"{nonce}:{extra}".encode(), hashlib.sha256).digest())
+    return values[0], values[1], values[2]
+
+
+# 系统 CSPRNG（os.urandom）：整批取随机字节后一次 translate 转换为点数
+class SystemStream:
+    commitment = None
+
+    def batch(self, count):
+        values = b""
+        while len(values) < 3 * count:
+            # 每字节约 1.6% 被丢弃，多取一些减少补取
+            values += faces(os.urandom((3 * count - len(values)) * 33 // 32 + 8))
+        it = iter(values[:3 * count])
+        return [(None, dice) for dice in zip(it, it, it)]
+
+
+# 承诺-揭示：随机种子只公布 SHA-256 哈希（commitment），结果由种子和递增的 nonce 确定；
+# 换种子时公布旧种子，玩家可自行核对哈希并重算每次结果
+class SeededStream:
+    def __init__(self, seed=None):
+        self.seed = seed or os.urandom(32)
+        self.commitment = hashlib.sha256(self.seed).hexdigest()
+        self.nonce = 0
+        self._lock = threading.Lock()
+
+    def batch(self, count):
+        with self._lock:
+            start = self.nonce
+            self.nonce += count
+        return [(nonce, seeded_roll(self.seed, nonce)) for nonce in range(start, start + count)]
+
+
+class Draw:
+    __slots__ = ("dice", "commitment", "nonce")
+
+    def __init__(self, dice, commitment, nonce):
+        self.dice = dice
+        self.commitment = commitment
+        self.nonce = nonce
+
+
+# 预先生成的结果缓冲：取到一半以下时在线程池中整批补充，取空时才在事件循环里同步生成一小批
+class DiceBuffer:
+    def __init__(self, stream, size):
+        self.stream = stream
+        self.size = size
+        self.drawn = 0
+        self._buffer = deque()
+        self._refill = None
+
+    def draw(self):
+        hit = bool(self._buffer)
+        metrics.cache_lookup("dice", hit)
+        if not hit:
+            self._buffer.extend(self.stream.batch(max(1, self.size // 8)))
+        nonce, dice = self._buffer.popleft()
+        self.drawn += 1
+        if len(self._buffer) < self.size // 2 and self._refill is None:
+            try:
+                self._refill = asyncio.get_running_loop().create_task(self._fill())
+            except RuntimeError:
+                pass
+        return Draw(dice, self.stream.commitment, nonce)
+
+    async def _fill(self):
+        try:
+            self._buffer.extend(await asyncio.to_thread(self.stream.batch, self.size - len(self._buffer)))
+        finally:
+            self._refill = None
+
+
+# 骰子服务。mode="system" 用系统 CSPRNG；mode="commit" 时每个聊天一条承诺-揭示结果流，
+# 每 rotate_after 次开奖换一次种子并公布旧种子；轮次模式每轮单独一个种子（见 round_stream）。
+# 设置 storage 时种子在使用前写入数据库（dice_seeds），关闭时公布全部种子；进程异常退出后，
+# 下次启动首次使用该聊天时公布上次未公布的种子。多进程部署时每个工作进程（shard）各自一条结果流，
+# 缓冲中未用完的结果不会在种子公布后继续使用
+class DiceService:
+    MODES = ("system", "commit")
+
+    def __init__(self, mode="system", buffer_size=4096, rotate_after=1000, storage=None, shard=0):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown dice mode {mode!r}, expected one of {', '.join(self.MODES)}")
+        self.mode = mode
+        self.buffer_size = buffer_size
+        self.rotate_after = rotate_after
+        self.storage = storage
+        self.shard = shard
+        self._system = DiceBuffer(SystemStream(), buffer_size)
+        self._chats = {}
+        # chat_id -> (已公布的旧种子, 其哈希, 开奖次数)
+        self._revealed = {}
+        # 换种子时需要读写数据库，避免并发开奖各自生成种子
+        self._lock = asyncio.Lock()
+
+    async def _chat_buffer(self, chat_id):
+        buffer = self._chats.get(chat_id)
+        if buffer is not None and buffer.drawn < self.rotate_after:
+            return buffer
+        async with self._lock:
+            buffer = self._chats.get(chat_id)
+            if buffer is not None and buffer.drawn < self.rotate_after:
+                return buffer
+            if buffer is not None:
+                revealed = (buffer.stream.seed.hex(), buffer.drawn)
+            elif self.storage is not None:
+                revealed = await self._load_revealed(chat_id)
+            else:
+                revealed = None
+            stream = SeededStream()
+            if self.storage is not None:
+                await self.storage.save_dice_seeds([(chat_id, self.shard, stream.seed.hex(),
+                                                     *(revealed or (None, None)))])
+            if revealed is not None:
+                self._revealed[chat_id] = _revealed(*revealed)
+            # 每个聊天的缓冲较小：换种子时未用完的结果作废
+            buffer = self._chats[chat_id] = DiceBuffer(stream, min(self.buffer_size, 64))
+            return buffer
+
+    # 本进程首次使用该聊天：上次未公布的种子（进程异常退出，开奖次数未知）现在公布，否则沿用已公布的种子
+    async def _load_revealed(self, chat_id):
+        for shard, seed, revealed_seed, revealed_draws in await self.storage.load_dice_seeds(chat_id):
+            if shard == self.shard:
+                if seed is not None:
+                    return seed, None
+                if revealed_seed is not None:
+                    return revealed_seed, revealed_draws
+        return None
+
+    async def roll(self, chat_id):
+        if self.mode == "commit":
+            return (await self._chat_buffer(chat_id)).draw()
+        return self._system.draw()
+
+    # 轮次使用的结果流：承诺-揭示模式下开局时公布哈希、开奖后公布种子；否则为 None（使用 roll）
+    def round_stream(self):
+        return SeededStream() if self.mode == "commit" else None
+
+    # 本聊天各结果流的 [(shard, 当前种子哈希, 已开奖次数, 上一个已公布的种子)]，按 shard 排序；
+    # 其他工作进程的结果流从数据库读取，开奖次数为 None
+    async def status(self, chat_id):
+        buffer = await self._chat_buffer(chat_id)
+        streams = {self.shard: (buffer.stream.commitment, buffer.drawn, self._revealed.get(chat_id))}
+        if self.storage is not None:
+            for shard, seed, revealed_seed, revealed_draws in await self.storage.load_dice_seeds(chat_id):
+                if shard != self.shard:
+                    streams[shard] = (hashlib.sha256(bytes.fromhex(seed)).hexdigest() if seed else None, None,
+                                      _revealed(revealed_seed, revealed_draws) if revealed_seed else None)
+        return [(shard, *streams[shard]) for shard in sorted(streams)]
+
+    # 关闭时公布本进程全部聊天的当前种子
+    async def close(self):
+        rows = [(chat_id, self.shard, None, buffer.stream.seed.hex(), buffer.drawn)
+                for chat_id, buffer in self._chats.items()]
+        self._chats.clear()
+        if rows and self.storage is not None:
+            await self.storage.save_dice_seeds(rows)
+
+
+def _revealed(seed, draws):
+    return seed, hashlib.sha256(bytes.fromhex(seed)).hexdigest(), draws
+
+
+# 卡方检验的 p 值（Wilson-Hilferty 近似，自由度较大时足够准确）
+def chi_square_p(statistic, df):
+    z = ((statistic / df) ** (1 / 3) - (1 - 2 / (9 * df))) / math.sqrt(2 / (9 * df))
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+# 统计自检：生成 rolls 个骰子（每次开奖 3 个），对单骰点数（自由度 5）和 216 种组合（自由度 215）做卡方检验
+def self_test(stream, rolls, batch=100000):
+    outcomes = Counter()
+    draws = max(1, rolls // 3)
+    started = time.perf_counter()
+    for start in range(0, draws, batch):
+        outcomes.update(outcome_index(dice) for _, dice in stream.batch(min(batch, draws - start)))
+    elapsed = time.perf_counter() - started
+    counts = [outcomes[index] for index in range(len(OUTCOMES))]
+    expected = draws / len(OUTCOMES)
+    combos = sum((count - expected) ** 2 / expected for count in counts)
+    face_counts = Counter()
+    for dice, count in zip(OUTCOMES, counts):
+        for face in dice:
+            face_counts[face] += count
+    expected = draws * 3 / 6
+    single = sum((face_counts[face] - expected) ** 2 / expected for face in range(1, 7))
+    return {
+        "rolls": draws * 3,
+        "rolls_per_s": round(draws * 3 / elapsed),
+        "faces_chi2": round(single, 2),
+        "faces_p": round(chi_square_p(single, 5), 4),
+        "combos_chi2": round(combos, 2),
+        "combos_p": round(chi_square_p(combos, 215), 4),
+    }
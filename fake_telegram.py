@@ -0,0 +1,84 @@
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+
+from telegram.request import BaseRequest
+
+BOT_USER = {"id": 1000000, "is_bot": True, "first_name": "FFC Bot", "username": "ffc_test_bot",
+            "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False}
+
+
+# 离线的 Bot API：替代 HTTP 请求层，记录每次 API 调用并返回固定格式的响应，用于压测和本地测试
+class FakeRequest(BaseRequest):
+    def __init__(self, admin_ids=(), latency=0.0):
+        self.admin_ids = list(admin_ids)
+        # 模拟网络往返耗时（秒）
+        self.latency = latency
+        self.calls = Counter()
+        self._message_id = 0
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def reset(self):
+        self.calls.clear()
+
+    def _message(self, params, **extra):
+        self._message_id += 1
+        chat_id = int(params.get("chat_id", 0))
+        message = {"message_id": self._message_id, "date": int(time.time()), "from": BOT_USER,
+                   "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"}}
+        message.update(extra)
+        return message
+
+    def _result(self, endpoint, params):
+        if endpoint == "getMe":
+            return BOT_USER
+        if endpoint == "getUpdates":
+            return []
+        if endpoint == "sendMessage":
+            return self._message(params, text=params.get("text", ""))
+        if endpoint == "editMessageText":
+            return self._message(params, text=params.get("text", ""))
+        if endpoint == "sendDice":
+            return self._message(params, dice={"emoji": params.get("emoji", "🎲"), "value": random.randint(1, 6)})
+        if endpoint == "getChatAdministrators":
+            return [{"status": "creator", "is_anonymous": False,
+                     "user": {"id": user_id, "is_bot": False, "first_name": f"admin{user_id}"}}
+                    for user_id in self.admin_ids]
+        return True
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        self.calls[endpoint] += 1
+        if endpoint == "getUpdates":
+            # 轮询模式下避免空转
+            await asyncio.sleep(0.5)
+        elif self.latency:
+            await asyncio.sleep(self.latency)
+        params = request_data.parameters if request_data is not None else {}
+        return 200, json.dumps({"ok": True, "result": self._result(endpoint, params)}).encode()
+
+
+# 构造一条文字消息更新（Update JSON）；以 / 开头时带上 bot_command 实体
+def make_update(update_id, user_id, chat_id, text, chat_type=None):
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": chat_type or ("private" if chat_id > 0 else "supergroup"), "title": "bench"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
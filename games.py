@@ -0,0 +1,253 @@
+import itertools
+from collections import Counter
+
+# 3 个骰子的全部 216 种结果，按 (d1-1)*36 + (d2-1)*6 + (d3-1) 编号
+OUTCOMES = list(itertools.product(range(1, 7), repeat=3))
+
+
+def outcome_index(dice):
+    d1, d2, d3 = dice
+    return (d1 - 1) * 36 + (d2 - 1) * 6 + (d3 - 1)
+
+
+# 玩法注册表：名称 -> BetType
+BET_TYPES = {}
+
+
+# 玩法基类。子类声明合法选项、参数解析和赔率；注册时预计算每个选项在 216 种结果下的赔率表，
+# 结算时只需一次查表
+class BetType:
+    name = ""
+    error = ""
+    # 是否计入连胜（连胜大师）
+    streak = False
+
+    def __init__(self):
+        self.tables = {
+            selection: tuple(self.multiplier(selection, dice) for dice in OUTCOMES)
+            for selection in self.selections()
+        }
+
+    # 全部合法选项
+    def selections(self):
+        raise NotImplementedError
+
+    # 解析下注参数为选项，非法时抛出 ValueError
+    def parse(self, bet):
+        raise NotImplementedError
+
+    # 该选项在给定结果下的赔率（含本金），0 表示未中
+    def multiplier(self, selection, dice):
+        raise NotImplementedError
+
+    def result_text(self, dice):
+        return f"🎲 结果：{dice[0]}-{dice[1]}-{dice[2]}"
+
+    def win_text(self, selection, dice, winnings):
+        return f"🎉 猜对！赢得 {winnings} 积分！"
+
+    def lose_text(self, selection, points):
+        return f"😅 猜错！扣除 {points} 积分。"
+
+    def tracks_streak(self, selection):
+        return self.streak
+
+    # 查表计算派彩
+    def payout(self, selection, dice, points):
+        return int(points * self.tables[selection][outcome_index(dice)])
+
+    # 每个选项的返奖率（RTP），按 216 种等概率结果精确计算
+    def rtp(self):
+        return {selection: sum(table) / len(OUTCOMES) for selection, table in self.tables.items()}
+
+
+def register(cls):
+    bet_type = cls()
+    BET_TYPES[bet_type.name] = bet_type
+    return cls
+
+
+# 大小：总和 >= 11 为大
+@register
+class SizeBet(BetType):
+    name = "size"
+    error = "请猜 big 或 small！"
+
+    def selections(self):
+        return ["big", "small"]
+
+    def parse(self, bet):
+        if bet not in self.selections():
+            raise ValueError(bet)
+        return bet
+
+    def multiplier(self, selection, dice):
+        return 1.8 if ("big" if sum(dice) >= 11 else "small") == selection else 0
+
+    def result_text(self, dice):
+        total = sum(dice)
+        return f"{super().result_text(dice)} (总和 {total})，{'大' if total >= 11 else '小'}"
+
+
+# 单双
+@register
+class ParityBet(BetType):
+    name = "parity"
+    error = "请猜 odd 或 even！"
+
+    def selections(self):
+        return ["odd", "even"]
+
+    def parse(self, bet):
+        if bet not in self.selections():
+            raise ValueError(bet)
+        return bet
+
+    def multiplier(self, selection, dice):
+        return 1.8 if ("even" if sum(dice) % 2 == 0 else "odd") == selection else 0
+
+    def result_text(self, dice):
+        total = sum(dice)
+        return f"{super().result_text(dice)} (总和 {total})，{'双' if total % 2 == 0 else '单'}"
+
+
+# 和值
+@register
+class SumBet(BetType):
+    name = "sum"
+    error = "总和需为 3-18 的整数！"
+    odds = {4: 50, 17: 50, 5: 18, 16: 18, 6: 14, 15: 14, 7: 12, 14: 12, 8: 8, 13: 8, 9: 6, 12: 6, 10: 6, 11: 6}
+
+    def selections(self):
+        return list(range(3, 19))
+
+    def parse(self, bet):
+        bet_sum = int(bet)
+        if bet_sum < 3 or bet_sum > 18:
+            raise ValueError(bet)
+        return bet_sum
+
+    def multiplier(self, selection, dice):
+        return self.odds.get(selection, 6) if sum(dice) == selection else 0
+
+    def result_text(self, dice):
+        return f"{super().result_text(dice)} (总和 {sum(dice)})"
+
+    def win_text(self, selection, dice, winnings):
+        return f"🎉 猜对总和！赢得 {winnings} 积分！"
+
+
+# 三同号：any 为通选，1-6 为单选
+@register
+class TripleBet(BetType):
+    name = "triple"
+    error = "三同号需为 1-6 或 any！"
+
+    def selections(self):
+        return ["any"] + list(range(1, 7))
+
+    def parse(self, bet):
+        if bet == "any":
+            return bet
+        bet_num = int(bet)
+        if bet_num < 1 or bet_num > 6:
+            raise ValueError(bet)
+        return bet_num
+
+    def multiplier(self, selection, dice):
+        if dice[0] != dice[1] or dice[1] != dice[2]:
+            return 0
+        if selection == "any":
+            return 30
+        return 150 if dice[0] == selection else 0
+
+    def win_text(self, selection, dice, winnings):
+        kind = "通选" if selection == "any" else "单选"
+        return f"🎉 三同号{kind}中奖！赢得 {winnings} 积分！"
+
+    def lose_text(self, selection, points):
+        if selection == "any":
+            return f"😅 未开豹子！扣除 {points} 积分。"
+        return f"😅 未中！扣除 {points} 积分。"
+
+    def tracks_streak(self, selection):
+        return selection != "any"
+
+
+# 二同号：any 为复选，X-X-Y 为单选
+@register
+class PairBet(BetType):
+    name = "pair"
+    error = "二同号需为 X-X-Y 格式，如 1-1-2！"
+
+    def selections(self):
+        return ["any"] + list(itertools.combinations_with_replacement(range(1, 7), 3))
+
+    def parse(self, bet):
+        if bet == "any":
+            return bet
+        bet_numbers = [int(x) for x in bet.split("-")]
+        if len(bet_numbers) != 3 or not all(1 <= x <= 6 for x in bet_numbers):
+            raise ValueError(bet)
+        return tuple(sorted(bet_numbers))
+
+    def multiplier(self, selection, dice):
+        if selection == "any":
+            return 5 if len(set(dice)) == 2 else 0
+        return 25 if tuple(sorted(dice)) == selection and len(set(selection)) == 2 else 0
+
+    def win_text(self, selection, dice, winnings):
+        kind = "复选" if selection == "any" else "单选"
+        return f"🎉 二同号{kind}中奖！赢得 {winnings} 积分！"
+
+    def lose_text(self, selection, points):
+        if selection == "any":
+            return f"😅 未开对子！扣除 {points} 积分。"
+        return f"😅 未中！扣除 {points} 积分。"
+
+    def tracks_streak(self, selection):
+        return selection != "any"
+
+
+# 单骰：按命中次数派彩
+@register
+class SingleBet(BetType):
+    name = "single"
+    error = "猜点数需为 1-6 的整数！"
+
+    def selections(self):
+        return list(range(1, 7))
+
+    def parse(self, bet):
+        bet_num = int(bet)
+        if bet_num < 1 or bet_num > 6:
+            raise ValueError(bet)
+        return bet_num
+
+    def multiplier(self, selection, dice):
+        return Counter(dice)[selection]
+
+    def win_text(self, selection, dice, winnings):
+        return f"🎉 猜中 {dice.count(selection)} 次！赢得 {winnings} 积分！"
+
+    def lose_text(self, selection, points):
+        return f"😅 未猜中！扣除 {points} 积分。"
+
+
+# 已注册玩法列表，用于提示文案
+def mode_names():
+    names = list(BET_TYPES)
+    return names[0] if len(names) == 1 else f"{', '.join(names[:-1])} 或 {names[-1]}"
+
+
+# 各玩法的返奖率与庄家优势
+def rtp_report():
+    lines = []
+    for name, bet_type in BET_TYPES.items():
+        for selection, rtp in bet_type.rtp().items():
+            lines.append(f"{name} {selection}: RTP {rtp:.4%}, 庄家优势 {1 - rtp:.4%}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    print(rtp_report())
@@ -0,0 +1,136 @@
+import logging
+import time
+from collections import OrderedDict
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class _Board:
+    __slots__ = ("rows", "complete", "loaded")
+
+    def __init__(self, rows, complete):
+        self.loaded = time.monotonic()
+        # [[user_id, username, points]]，按积分降序、user_id 升序
+        self.rows = rows
+        # 为 True 时 rows 就是该榜全部用户
+        self.complete = complete
+
+    def index(self, user_id):
+        for i, row in enumerate(self.rows):
+            if row[0] == user_id:
+                return i
+        return None
+
+    def insert(self, user_id, username, points):
+        key = (-points, user_id)
+        for i, row in enumerate(self.rows):
+            if (-row[2], row[0]) > key:
+                self.rows.insert(i, [user_id, username, points])
+                return
+        self.rows.append([user_id, username, points])
+
+    def qualifies(self, user_id, points):
+        return bool(self.rows) and (-points, user_id) < (-self.rows[-1][2], self.rows[-1][0])
+
+    # 积分变动后就地调整；返回 False 表示无法就地维护，需要丢弃缓存重新加载
+    # 群榜的新成员由 Leaderboard 单独处理，因此完整群榜里找不到的用户一定不是该群成员
+    def apply(self, user_id, username, points, size, is_global):
+        i = self.index(user_id)
+        if i is not None:
+            username = username or self.rows[i][1]
+            del self.rows[i]
+        elif self.complete:
+            if not is_global:
+                return True
+        elif not self.qualifies(user_id, points):
+            return True
+        elif not is_global:
+            # 可能进榜，但不确定是否为群成员
+            return False
+        # 缓存里的用户都不低于榜外用户，所以掉出缓存末位时直接截断即可，剩余部分仍是真实的前 N 名
+        if self.complete or self.qualifies(user_id, points):
+            if username is None:
+                return False
+            self.insert(user_id, username, points)
+        elif not self.rows:
+            return False
+        if len(self.rows) > size:
+            del self.rows[size:]
+            self.complete = False
+        return True
+
+
+# 排行榜缓存：全局榜和最近访问的若干个群榜各缓存前 size 名，通过 Storage 的积分变动通知增量维护
+# 多进程部署时其他进程的积分变动收不到通知，ttl 控制缓存最长使用多久（None 表示一直有效）
+class Leaderboard:
+    def __init__(self, storage, size=50, max_chats=256, page_size=5, ttl=None):
+        self.storage = storage
+        self.ttl = ttl
+        self.size = size
+        self.max_chats = max_chats
+        self.page_size = page_size
+        self._global = None
+        self._chats = OrderedDict()
+        # 每次积分变动递增；加载期间发生变动时不缓存加载结果
+        self._version = 0
+        storage.add_listener(self.on_points_changed)
+
+    def on_points_changed(self, changes, members=()):
+        self._version += 1
+        if changes is None:
+            self._global = None
+            self._chats.clear()
+            return
+        # 有新成员的群榜直接丢弃
+        for chat_id, _ in members:
+            self._chats.pop(chat_id, None)
+        for user_id, username, points in changes:
+            if self._global is not None and not self._global.apply(user_id, username, points, self.size, True):
+                self._global = None
+            for chat_id, board in list(self._chats.items()):
+                if not board.apply(user_id, username, points, self.size, False):
+                    del self._chats[chat_id]
+
+    async def _board(self, chat_id):
+        board = self._global if chat_id is None else self._chats.get(chat_id)
+        if board is not None and self.ttl is not None and time.monotonic() - board.loaded > self.ttl:
+            board = None
+        metrics.cache_lookup("leaderboard", board is not None)
+        if board is not None:
+            if chat_id is not None:
+                self._chats.move_to_end(chat_id)
+            return board
+        version = self._version
+        rows = await self.storage.top_users(self.size, chat_id=chat_id)
+        board = _Board([list(row) for row in rows], len(rows) < self.size)
+        if version != self._version:
+            return board
+        if chat_id is None:
+            self._global = board
+        else:
+            self._chats[chat_id] = board
+            if len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        return board
+
+    # 第 page 页（从 1 开始），返回 [(名次, username, points)]
+    async def page(self, page=1, chat_id=None):
+        start = (page - 1) * self.page_size
+        end = start + self.page_size
+        board = await self._board(chat_id)
+        if end <= len(board.rows) or board.complete:
+            rows = board.rows[start:end]
+        else:
+            # 超出缓存范围的页直接查库
+            rows = await self.storage.top_users(self.page_size, start, chat_id)
+        return [(start + i + 1, row[1], row[2]) for i, row in enumerate(rows)]
+
+    # 用户名次，先查缓存，不在缓存中时走索引计数
+    async def rank(self, user_id, chat_id=None):
+        board = await self._board(chat_id)
+        i = board.index(user_id)
+        if i is not None:
+            return i + 1, board.rows[i][2]
+        return await self.storage.rank(user_id, chat_id)
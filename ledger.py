@@ -0,0 +1,45 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+
+# 积分流水的定期维护：每 interval 秒做一次增量余额快照；retention_days > 0 时删除快照之前、
+# 早于保留期的流水（删除前如需归档，用 dbtool export 导出 ledger 表）
+class LedgerMaintenance:
+    def __init__(self, storage, interval=3600.0, retention_days=0):
+        self.storage = storage
+        self.interval = interval
+        self.retention_days = retention_days
+        self._task = None
+
+    async def run_once(self):
+        mark, users = await self.storage.snapshot()
+        logger.info(f"Ledger snapshot at entry {mark}: {users} balances updated")
+        if self.retention_days > 0:
+            before = (datetime.now() - timedelta(days=self.retention_days)).isoformat(timespec="seconds")
+            removed = await self.storage.compact_ledger(before)
+            if removed:
+                logger.info(f"Compacted {removed} ledger entries older than {before}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"Error in ledger maintenance: {str(e)}")
+
+    def start(self):
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,303 @@
+import asyncio
+import bisect
+import functools
+import logging
+import os
+import random
+import time
+
+from telegram.ext import ApplicationHandlerStop
+
+logger = logging.getLogger(__name__)
+
+# 延迟直方图的默认分桶（秒）
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+# Prometheus 文本格式的指标，不依赖 prometheus_client；labels 为标签名，按位置传入标签值
+class _Metric:
+    kind = ""
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        REGISTRY.append(self)
+
+    def _label_text(self, values, extra=""):
+        pairs = [f'{name}="{value}"' for name, value in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines += self._samples()
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self._values = {}
+
+    def inc(self, *values, amount=1):
+        self._values[values] = self._values.get(values, 0) + amount
+
+    def _samples(self):
+        return [f"{self.name}{self._label_text(values)} {value}" for values, value in sorted(self._values.items())]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self._values = {}
+
+    def set(self, value, *values):
+        self._values[values] = value
+
+    def _samples(self):
+        return [f"{self.name}{self._label_text(values)} {value}" for values, value in sorted(self._values.items())]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        # 标签值 -> [各分桶计数..., 总数, 总和]
+        self._values = {}
+
+    def observe(self, value, *values):
+        entry = self._values.get(values)
+        if entry is None:
+            entry = self._values[values] = [0] * (len(self.buckets) + 1) + [0.0]
+        entry[bisect.bisect_left(self.buckets, value)] += 1
+        entry[-1] += value
+
+    def _samples(self):
+        lines = []
+        for values, entry in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, entry):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{self._label_text(values, le)} {cumulative}")
+            total = cumulative + entry[len(self.buckets)]
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{self._label_text(values, le)} {total}")
+            lines.append(f"{self.name}_sum{self._label_text(values)} {entry[-1]}")
+            lines.append(f"{self.name}_count{self._label_text(values)} {total}")
+        return lines
+
+
+# 把已有的 stats 计数器（collections.Counter，如限流统计）按 event 标签导出
+class StatsCollector(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, stats):
+        super().__init__(name, help, ("event",))
+        self.stats = stats
+
+    def _samples(self):
+        return [f"{self.name}{self._label_text((event,))} {value}" for event, value in sorted(self.stats.items())]
+
+
+REGISTRY = []
+
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Handler latency", ("handler",))
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Exceptions raised by handlers", ("handler",))
+DB_SECONDS = Histogram("bot_db_call_seconds", "Storage call latency (count is the number of calls)", ("op",))
+DB_ERRORS = Counter("bot_db_errors_total", "Storage calls that raised", ("op",))
+API_SECONDS = Histogram("bot_api_call_seconds", "Telegram Bot API call latency, excluding rate limiter waits",
+                        ("method",))
+API_ERRORS = Counter("bot_api_errors_total", "Telegram Bot API calls that raised", ("method",))
+CACHE_REQUESTS = Counter("bot_cache_requests_total", "Cache lookups by result (hit/miss)", ("cache", "result"))
+LOOP_LAG = Histogram("bot_event_loop_lag_seconds", "How late the event loop woke up a periodic timer",
+                     buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+STARTUP_SECONDS = Gauge("bot_startup_seconds", "Seconds from process start to each startup phase", ("phase",))
+LOOP_LAG_LAST = Gauge("bot_event_loop_lag_last_seconds", "Most recent event loop lag sample")
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+# 进程启动时刻（monotonic 时间）：Linux 下从 /proc 读取，其他系统以本模块首次导入为准
+def _process_started():
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return time.monotonic() - (uptime - start_ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError, AttributeError):
+        return time.monotonic()
+
+
+STARTED = _process_started()
+
+
+# 记录启动阶段（ready：初始化完成；first_update：处理第一条更新）距进程启动的耗时，每个阶段只记一次
+def startup_phase(phase):
+    if (phase,) in STARTUP_SECONDS._values:
+        return None
+    seconds = round(time.monotonic() - STARTED, 3)
+    STARTUP_SECONDS.set(seconds, phase)
+    logger.info(f"Startup phase {phase} reached after {seconds:.2f}s")
+    return seconds
+
+
+def cache_lookup(cache, hit):
+    CACHE_REQUESTS.inc(cache, "hit" if hit else "miss")
+
+
+# 包装处理器，记录耗时和异常；ApplicationHandlerStop 等控制流异常照常抛出
+def track_handler(callback, name=None):
+    name = name or callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except ApplicationHandlerStop:
+            raise
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+    return wrapper
+
+
+# 给存储后端的公开方法（storage.OPERATIONS）套上计时，按方法名打标签，对 SQLite 和 PostgreSQL 后端都适用
+def instrument_storage(storage):
+    for op in storage.OPERATIONS:
+        method = getattr(storage, op)
+
+        async def timed(*args, _method=method, _op=op, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await _method(*args, **kwargs)
+            except Exception:
+                DB_ERRORS.inc(_op)
+                raise
+            finally:
+                DB_SECONDS.observe(time.perf_counter() - started, _op)
+        setattr(storage, op, timed)
+    return storage
+
+
+# 记录一次 Bot API 调用（由出站限流器在实际请求前后调用）
+async def timed_api_call(endpoint, callback, *args, **kwargs):
+    started = time.perf_counter()
+    try:
+        return await callback(*args, **kwargs)
+    except Exception:
+        API_ERRORS.inc(endpoint)
+        raise
+    finally:
+        API_SECONDS.observe(time.perf_counter() - started, endpoint)
+
+
+# 事件循环延迟：定时 sleep(interval)，实际醒来时间比预期晚多少即为延迟
+class LoopLagMonitor:
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            LOOP_LAG.observe(lag)
+            LOOP_LAG_LAST.set(round(lag, 6))
+
+
+# 本地 /metrics HTTP 端点（Prometheus 抓取），只处理 GET /metrics，其余返回 404
+class MetricsServer:
+    def __init__(self, host="127.0.0.1", port=9108):
+        self.host = host
+        self.port = port
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info(f"Metrics available at http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", render().encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            logger.debug(f"Metrics request failed: {str(e)}")
+        finally:
+            writer.close()
+
+
+# 高频事件日志（如每次积分变动）：按 sample 比例抽样，以 key=value 形式输出，级别可配置
+class SampledLog:
+    def __init__(self, logger, level=logging.DEBUG, sample=1.0):
+        self.logger = logger
+        self._random = random.Random()
+        self.configure(level, sample)
+
+    # 配置错误在启动时抛出 ValueError，而不是等到写事务中记日志时才失败
+    def configure(self, level=None, sample=None):
+        if level is not None:
+            value = logging.getLevelName(level.upper()) if isinstance(level, str) else level
+            if not isinstance(value, int):
+                raise ValueError(f"Unknown log level {level!r}")
+            self.level = value
+        if sample is not None:
+            sample = float(sample)
+            if not 0.0 <= sample <= 1.0:
+                raise ValueError(f"Log sample must be between 0 and 1, got {sample}")
+            self.sample = sample
+
+    def __call__(self, event, **fields):
+        if not self.logger.isEnabledFor(self.level):
+            return
+        if self.sample < 1.0 and self._random.random() >= self.sample:
+            return
+        text = " ".join(f"{key}={value}" for key, value in fields.items())
+        self.logger.log(self.level, f"{event} {text}")
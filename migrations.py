@@ -0,0 +1,237 @@
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+# 一次结构变更：同一个版本号分别给出 SQLite 和 PostgreSQL 的语句
+class Migration:
+    def __init__(self, version, description, sqlite, postgres):
+        self.version = version
+        self.description = description
+        self.sqlite = sqlite
+        self.postgres = postgres
+
+
+# 按版本号递增追加，已发布的迁移不要修改。版本 1 使用 IF NOT EXISTS，兼容没有版本记录的旧 points.db
+MIGRATIONS = [
+    Migration(1, "users and achievements", [
+        """CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            points INTEGER DEFAULT 0,
+            last_message TIMESTAMP,
+            consecutive_wins INTEGER DEFAULT 0
+        )""",
+        """CREATE TABLE IF NOT EXISTS achievements (
+            user_id INTEGER,
+            achievement_name TEXT,
+            unlocked INTEGER DEFAULT 0,
+            progress INTEGER DEFAULT 0,
+            PRIMARY KEY (user_id, achievement_name)
+        )""",
+    ], [
+        # last_message 沿用 SQLite 中的 ISO 格式字符串
+        """CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            username TEXT,
+            points BIGINT NOT NULL DEFAULT 0,
+            last_message TEXT,
+            consecutive_wins INTEGER NOT NULL DEFAULT 0
+        )""",
+        """CREATE TABLE IF NOT EXISTS achievements (
+            user_id BIGINT,
+            achievement_name TEXT,
+            unlocked INTEGER NOT NULL DEFAULT 0,
+            progress INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, achievement_name)
+        )""",
+    ]),
+    Migration(2, "chat members and leaderboard indexes", [
+        """CREATE TABLE IF NOT EXISTS chat_members (
+            chat_id INTEGER,
+            user_id INTEGER,
+            PRIMARY KEY (chat_id, user_id)
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_users_points ON users (points DESC, user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_users_username ON users (username)",
+    ], [
+        """CREATE TABLE IF NOT EXISTS chat_members (
+            chat_id BIGINT,
+            user_id BIGINT,
+            PRIMARY KEY (chat_id, user_id)
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_users_points ON users (points DESC, user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_users_username ON users (username)",
+    ]),
+    Migration(3, "chat settings", [
+        """CREATE TABLE IF NOT EXISTS chat_settings (
+            chat_id INTEGER PRIMARY KEY,
+            fast_mode INTEGER DEFAULT 0
+        )""",
+    ], [
+        """CREATE TABLE IF NOT EXISTS chat_settings (
+            chat_id BIGINT PRIMARY KEY,
+            fast_mode INTEGER NOT NULL DEFAULT 0
+        )""",
+    ]),
+    Migration(4, "round mode setting", [
+        "ALTER TABLE chat_settings ADD COLUMN round_seconds INTEGER DEFAULT 0",
+    ], [
+        "ALTER TABLE chat_settings ADD COLUMN IF NOT EXISTS round_seconds INTEGER NOT NULL DEFAULT 0",
+    ]),
+    # 积分流水：只追加；users.points 是流水的实时汇总，balance_snapshots 为各用户在某条流水处的余额快照，
+    # 快照之前的流水可以归档删除。已有余额记为一条期初流水
+    Migration(5, "points ledger and balance snapshots", [
+        """CREATE TABLE IF NOT EXISTS ledger (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            chat_id INTEGER,
+            delta INTEGER NOT NULL,
+            balance INTEGER NOT NULL,
+            reason TEXT NOT NULL,
+            details TEXT,
+            created_at TEXT NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_ledger_user ON ledger (user_id, id)",
+        """CREATE TABLE IF NOT EXISTS balance_snapshots (
+            user_id INTEGER PRIMARY KEY,
+            points INTEGER NOT NULL,
+            ledger_id INTEGER NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS ledger_snapshots (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ledger_id INTEGER NOT NULL,
+            users INTEGER NOT NULL,
+            created_at TEXT NOT NULL
+        )""",
+        """INSERT INTO ledger (user_id, delta, balance, reason, created_at)
+           SELECT user_id, points, points, 'opening', strftime('%Y-%m-%dT%H:%M:%S', 'now', 'localtime')
+           FROM users WHERE points != 0 ORDER BY user_id""",
+    ], [
+        """CREATE TABLE IF NOT EXISTS ledger (
+            id BIGSERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            chat_id BIGINT,
+            delta BIGINT NOT NULL,
+            balance BIGINT NOT NULL,
+            reason TEXT NOT NULL,
+            details TEXT,
+            created_at TEXT NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_ledger_user ON ledger (user_id, id)",
+        """CREATE TABLE IF NOT EXISTS balance_snapshots (
+            user_id BIGINT PRIMARY KEY,
+            points BIGINT NOT NULL,
+            ledger_id BIGINT NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS ledger_snapshots (
+            id BIGSERIAL PRIMARY KEY,
+            ledger_id BIGINT NOT NULL,
+            users INTEGER NOT NULL,
+            created_at TEXT NOT NULL
+        )""",
+        """INSERT INTO ledger (user_id, delta, balance, reason, created_at)
+           SELECT user_id, points, points, 'opening', to_char(localtimestamp, 'YYYY-MM-DD"T"HH24:MI:SS')
+           FROM users WHERE points != 0 ORDER BY user_id""",
+    ]),
+    # 运行时状态（如已设置的指令菜单哈希），不导出
+    Migration(6, "bot settings", [
+        """CREATE TABLE IF NOT EXISTS bot_settings (
+            name TEXT PRIMARY KEY,
+            value TEXT
+        )""",
+    ], [
+        """CREATE TABLE IF NOT EXISTS bot_settings (
+            name TEXT PRIMARY KEY,
+            value TEXT
+        )""",
+    ]),
+    # 承诺-揭示模式每个聊天、每个工作进程（shard）的结果流：seed 为未公布的当前种子（十六进制），
+    # revealed_seed / revealed_draws 为已公布的上一个种子及其开奖次数（进程异常退出时次数未知，为 NULL）。运行时状态，不导出
+    Migration(7, "dice seeds", [
+        """CREATE TABLE IF NOT EXISTS dice_seeds (
+            chat_id INTEGER,
+            shard INTEGER,
+            seed TEXT,
+            revealed_seed TEXT,
+            revealed_draws INTEGER,
+            PRIMARY KEY (chat_id, shard)
+        )""",
+    ], [
+        """CREATE TABLE IF NOT EXISTS dice_seeds (
+            chat_id BIGINT,
+            shard INTEGER,
+            seed TEXT,
+            revealed_seed TEXT,
+            revealed_draws INTEGER,
+            PRIMARY KEY (chat_id, shard)
+        )""",
+    ]),
+]
+
+# 导出/导入的表和列（按主键顺序导出）
+TABLES = {
+    "users": ["user_id", "username", "points", "last_message", "consecutive_wins"],
+    "achievements": ["user_id", "achievement_name", "unlocked", "progress"],
+    "chat_members": ["chat_id", "user_id"],
+    "chat_settings": ["chat_id", "fast_mode", "round_seconds"],
+    "ledger": ["id", "user_id", "chat_id", "delta", "balance", "reason", "details", "created_at"],
+    "balance_snapshots": ["user_id", "points", "ledger_id"],
+    "ledger_snapshots": ["id", "ledger_id", "users", "created_at"],
+}
+PRIMARY_KEYS = {
+    "users": ["user_id"],
+    "achievements": ["user_id", "achievement_name"],
+    "chat_members": ["chat_id", "user_id"],
+    "chat_settings": ["chat_id"],
+    "ledger": ["id"],
+    "balance_snapshots": ["user_id"],
+    "ledger_snapshots": ["id"],
+}
+
+VERSION_TABLE = """CREATE TABLE IF NOT EXISTS schema_version (
+    version INTEGER PRIMARY KEY,
+    description TEXT,
+    applied_at TEXT
+)"""
+
+
+def latest_version():
+    return MIGRATIONS[-1].version
+
+
+# 在 SQLite 事务中执行尚未应用的迁移，返回应用的版本号列表
+def migrate_sqlite(c):
+    c.execute(VERSION_TABLE)
+    current = c.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+    applied = []
+    for migration in MIGRATIONS:
+        if migration.version <= current:
+            continue
+        for statement in migration.sqlite:
+            c.execute(statement)
+        c.execute("INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                  (migration.version, migration.description, datetime.now().isoformat()))
+        applied.append(migration.version)
+        logger.info(f"Applied migration {migration.version}: {migration.description}")
+    return applied
+
+
+# 在 PostgreSQL 连接上执行尚未应用的迁移；用事务级咨询锁避免多个进程同时迁移
+async def migrate_postgres(conn):
+    async with conn.transaction():
+        await conn.execute("SELECT pg_advisory_xact_lock(726354)")
+        await conn.execute(VERSION_TABLE)
+        current = await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+        applied = []
+        for migration in MIGRATIONS:
+            if migration.version <= current:
+                continue
+            for statement in migration.postgres:
+                await conn.execute(statement)
+            await conn.execute("INSERT INTO schema_version (version, description, applied_at) VALUES ($1, $2, $3)",
+                               migration.version, migration.description, datetime.now().isoformat())
+            applied.append(migration.version)
+            logger.info(f"Applied migration {migration.version}: {migration.description}")
+        return applied
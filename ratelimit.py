@@ -0,0 +1,182 @@
+import asyncio
+import logging
+import time
+from collections import Counter, OrderedDict
+
+from telegram.error import RetryAfter
+from telegram.ext import ApplicationHandlerStop, BaseRateLimiter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+# 令牌桶：period 秒内最多 capacity 次，允许突发
+class TokenBucket:
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(self, capacity, period):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # 立即取一个令牌，没有则返回 False
+    def take(self, now=None):
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    # 预约一个令牌（可以透支），返回需要等待的秒数；按调用顺序排队
+    def reserve(self, now=None):
+        self._refill(time.monotonic() if now is None else now)
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    # 现在预约需要等待的秒数（不预约）
+    def delay(self, now=None):
+        self._refill(time.monotonic() if now is None else now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+# 解析 "5/10" 形式的限流配置：10 秒内最多 5 次
+def parse_limit(value):
+    capacity, period = value.split("/")
+    return float(capacity), float(period)
+
+
+# 解析 "play=3/5,addallpoints=1/60" 形式的按命令限流配置
+def parse_command_limits(value):
+    limits = {}
+    for item in value.split(","):
+        if item.strip():
+            command, limit = item.split("=")
+            limits[command.strip().lower()] = parse_limit(limit.strip())
+    return limits
+
+
+class _Buckets:
+    def __init__(self, limit, max_size):
+        self.limit = limit
+        self.max_size = max_size
+        self._buckets = OrderedDict()
+
+    def get(self, key):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(*self.limit)
+            if len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+
+# 入站限流：挂在 group -1 的 TypeHandler 上，命令超出每用户/每群/每命令的频率时直接丢弃该更新。
+# 设置 outgoing（OutgoingRateLimiter）后，会话的出站排队超过 max_backlog 秒时也丢弃该会话的新命令：
+# 否则处理器在发送时排队等待，占满并发处理的名额，拖慢其他会话
+class FloodControl:
+    def __init__(self, user="5/10", chat="30/10", commands=None, max_buckets=100000, outgoing=None, max_backlog=30.0):
+        self.outgoing = outgoing
+        self.max_backlog = max_backlog
+        self._users = _Buckets(parse_limit(user), max_buckets)
+        self._chats = _Buckets(parse_limit(chat), max_buckets)
+        self._commands = {command: _Buckets(limit, max_buckets) for command, limit in (commands or {}).items()}
+        # 被限流后只提示一次，直到恢复
+        self._warned = set()
+        self.stats = Counter()
+
+    # 返回被哪一级限流（"user" / "chat" / "command:<名称>" / "backlog"），未限流返回 None。
+    # 先确认各级都有令牌再统一扣除，被某一级拒绝的命令不消耗其他级的额度
+    def check(self, user_id, chat_id, command):
+        levels = []
+        buckets = self._commands.get(command)
+        if buckets is not None:
+            levels.append((f"command:{command}", buckets.get(user_id)))
+        levels.append(("user", self._users.get(user_id)))
+        if chat_id is not None:
+            levels.append(("chat", self._chats.get(chat_id)))
+        # 在取出（可能新建）令牌桶之后取时间，新桶的 updated 不会晚于 now
+        now = time.monotonic()
+        for reason, bucket in levels:
+            if bucket.delay(now) > 0:
+                return reason
+        if self.outgoing is not None and chat_id is not None and self.outgoing.backlog(chat_id) > self.max_backlog:
+            return "backlog"
+        for _, bucket in levels:
+            bucket.take(now)
+        return None
+
+    async def handle(self, update, context):
+        message = update.effective_message
+        if message is None or not message.text or not message.text.startswith("/") or update.effective_user is None:
+            return
+        command = message.text.split()[0][1:].split("@")[0].lower()
+        user_id = update.effective_user.id
+        chat_id = update.effective_chat.id if update.effective_chat else None
+        reason = self.check(user_id, chat_id, command)
+        if reason is None:
+            self._warned.discard(user_id)
+            return
+        self.stats[f"throttled_{reason}"] += 1
+        logger.debug(f"Throttled /{command} from user {user_id} in chat {chat_id}: {reason}")
+        # 出站已积压的会话不再追加提示
+        if reason != "backlog" and user_id not in self._warned:
+            self._warned.add(user_id)
+            await message.reply_text("操作太频繁，请稍后再试！")
+        raise ApplicationHandlerStop
+
+
+# 出站限流：全局、每个群、每个私聊分别排队，遇到 429 RetryAfter 时暂停所有请求并自动重试
+class OutgoingRateLimiter(BaseRateLimiter):
+    def __init__(self, overall="30/1", group="20/60", private="3/1", max_retries=3, max_chats=10000):
+        self.overall = parse_limit(overall)
+        self.max_retries = max_retries
+        self._groups = _Buckets(parse_limit(group), max_chats)
+        self._private = _Buckets(parse_limit(private), max_chats)
+        self._overall = None
+        self._paused_until = 0.0
+        self.stats = Counter()
+
+    async def initialize(self):
+        self._overall = TokenBucket(*self.overall)
+
+    async def shutdown(self):
+        pass
+
+    # 向该会话发送消息目前需要排队的秒数
+    def backlog(self, chat_id):
+        return (self._private.get(chat_id) if chat_id > 0 else self._groups.get(chat_id)).delay()
+
+    async def _wait(self, bucket):
+        delay = bucket.reserve()
+        if delay > 0:
+            self.stats["queued"] += 1
+            self.stats["queued_seconds"] += delay
+            await asyncio.sleep(delay)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        for attempt in range(self.max_retries + 1):
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            # 只对发送类请求按会话限流
+            if isinstance(chat_id, int) and endpoint.startswith("send"):
+                await self._wait(self._private.get(chat_id) if chat_id > 0 else self._groups.get(chat_id))
+            await self._wait(self._overall)
+            try:
+                return await metrics.timed_api_call(endpoint, callback, *args, **kwargs)
+            except RetryAfter as e:
+                self.stats["retry_after"] += 1
+                if attempt == self.max_retries:
+                    raise
+                retry_after = float(e.retry_after)
+                logger.warning(f"Flood limit hit on {endpoint}, retrying in {retry_after}s")
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
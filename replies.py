@@ -0,0 +1,66 @@
+import asyncio
+import logging
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+# 合并回复：多段文字合成一条消息发送，骰子动画并发发送，并在消息末尾注明本次用了几次 API 调用
+class ReplyBuilder:
+    def __init__(self, message):
+        self.message = message
+        self.lines = []
+        self.api_calls = 0
+        self._dice = None
+
+    def add(self, text):
+        self.lines.append(text)
+        return self
+
+    # 并发发送骰子动画（后台进行，send 前会等待完成）
+    def dice(self, count=3, emoji="🎲"):
+        self.api_calls += count
+        self._dice = asyncio.gather(*(self.message.reply_dice(emoji=emoji) for _ in range(count)),
+                                    return_exceptions=True)
+        return self
+
+    # 丢弃已收集的文字（例如结算失败时改发错误提示）
+    def clear(self):
+        self.lines = []
+        return self
+
+    async def send(self):
+        if self._dice is not None:
+            for result in await self._dice:
+                if isinstance(result, Exception):
+                    logger.error(f"Error sending dice: {str(result)}")
+            self._dice = None
+        if not self.lines:
+            return None
+        self.api_calls += 1
+        self.lines.append(f"📨 本次回复共 {self.api_calls} 次 API 调用")
+        return await self.message.reply_text("\n".join(self.lines))
+
+
+# 每个群的快速模式开关（开启后 /play 不发送骰子动画）；首次访问时从数据库读取后缓存
+# 多进程部署时其他进程也可能修改设置，ttl 控制缓存多久后重新读取（None 表示一直有效）
+class FastMode:
+    def __init__(self, storage, ttl=None):
+        self.storage = storage
+        self.ttl = ttl
+        # chat_id -> (开关, 读取时间)
+        self._chats = {}
+
+    async def enabled(self, chat_id):
+        entry = self._chats.get(chat_id)
+        hit = entry is not None and (self.ttl is None or time.monotonic() - entry[1] <= self.ttl)
+        metrics.cache_lookup("fast_mode", hit)
+        if not hit:
+            entry = self._chats[chat_id] = (await self.storage.get_fast_mode(chat_id), time.monotonic())
+        return entry[0]
+
+    async def set(self, chat_id, enabled):
+        await self.storage.set_fast_mode(chat_id, enabled)
+        self._chats[chat_id] = (enabled, time.monotonic())
@@ -0,0 +1,181 @@
+import asyncio
+import logging
+import time
+
+from replies import ReplyBuilder
+
+logger = logging.getLogger(__name__)
+
+
+class _Bet:
+    __slots__ = ("user_id", "username", "name", "bet_type", "selection", "stake", "label")
+
+    def __init__(self, user_id, username, name, bet_type, selection, stake, label):
+        self.user_id = user_id
+        self.username = username
+        self.name = name
+        self.bet_type = bet_type
+        self.selection = selection
+        self.stake = stake
+        # 注单说明（原始下注参数），记入积分流水
+        self.label = label
+
+
+class _Round:
+    def __init__(self, chat_id, seconds, message):
+        self.chat_id = chat_id
+        self.seconds = seconds
+        # 第一注的消息；开局公告发送失败时结果回复到这里
+        self.message = message
+        self.announcement = None
+        self.bets = []
+        # 本轮的承诺-揭示结果流，None 表示使用系统随机数
+        self.stream = None
+        # user_id -> 本轮已下注总额
+        self.stakes = {}
+        self.wake = asyncio.Event()
+        self.task = None
+
+
+# 群内下注轮次（分分彩）：本群第一注开启一轮，seconds 秒内的下注共用同一次开奖；
+# 开奖时所有注单在一个事务中结算，骰子动画和结果各发一次。轮次状态在内存中，而多进程部署按用户分发更新，
+# 同一群的下注会落到不同工作进程各自开局，因此工作进程中 enabled 为 False：轮次模式视为关闭，下注立即开奖。
+# 承诺-揭示模式下开局公告附本轮种子哈希，开奖结果附种子
+class RoundManager:
+    def __init__(self, storage, achievement_engine, fast_mode, dice, ttl=None, max_lines=40):
+        self.storage = storage
+        self.achievement_engine = achievement_engine
+        self.fast_mode = fast_mode
+        self.dice = dice
+        self.ttl = ttl
+        # 结果消息最多列出的用户数，避免超过消息长度上限
+        self.max_lines = max_lines
+        self.enabled = True
+        self._rounds = {}
+        # chat_id -> (轮次时长, 读取时间)，同 FastMode 的缓存方式
+        self._settings = {}
+
+    # 本群轮次时长（秒），0 表示关闭轮次模式
+    async def seconds(self, chat_id):
+        if not self.enabled:
+            return 0
+        entry = self._settings.get(chat_id)
+        if entry is None or (self.ttl is not None and time.monotonic() - entry[1] > self.ttl):
+            entry = self._settings[chat_id] = (await self.storage.get_round_seconds(chat_id), time.monotonic())
+        return entry[0]
+
+    async def set_seconds(self, chat_id, seconds):
+        await self.storage.set_round_seconds(chat_id, seconds)
+        self._settings[chat_id] = (seconds, time.monotonic())
+
+    # 加入本群当前一轮（没有则以 seconds 秒开局），返回需要回复给用户的提示，None 表示已接受且无需单独回复
+    async def place(self, message, user, bet_type, selection, stake, seconds, label=None):
+        chat_id = message.chat_id
+        game = self._rounds.get(chat_id)
+        pending = (game.stakes.get(user.id, 0) if game else 0) + stake
+        # 只做余额预检；结算时由条件 UPDATE 保证不透支
+        if await self.storage.get_points(user.id) < pending:
+            return "积分不足！"
+        game = self._rounds.get(chat_id)
+        if game is None:
+            game = self._rounds[chat_id] = _Round(chat_id, seconds, message)
+            game.stream = self.dice.round_stream()
+            text = f"🎲 新一轮开始！{seconds} 秒内 /play 下注，到时统一开奖。"
+            if game.stream is not None:
+                text += f"\n🔐 本轮种子哈希：{game.stream.commitment}"
+            game.announcement = asyncio.ensure_future(message.reply_text(text))
+            game.task = asyncio.create_task(self._run(game))
+        game.bets.append(_Bet(user.id, user.username, user.username or user.first_name, bet_type, selection, stake,
+                              label or f"{bet_type.name} {stake}"))
+        game.stakes[user.id] = game.stakes.get(user.id, 0) + stake
+        return None
+
+    async def _run(self, game):
+        try:
+            await asyncio.wait_for(game.wake.wait(), game.seconds)
+        except asyncio.TimeoutError:
+            pass
+        if self._rounds.get(game.chat_id) is game:
+            del self._rounds[game.chat_id]
+        try:
+            await self._settle(game)
+        except Exception as e:
+            logger.error(f"Error settling round in chat {game.chat_id}: {str(e)}")
+
+    async def _settle(self, game):
+        anchor = game.message
+        try:
+            anchor = await game.announcement
+        except Exception as e:
+            logger.error(f"Error announcing round in chat {game.chat_id}: {str(e)}")
+        if game.stream is not None:
+            (_, dice), = game.stream.batch(1)
+        else:
+            dice = (await self.dice.roll(game.chat_id)).dice
+        reply = ReplyBuilder(anchor)
+        if not await self.fast_mode.enabled(game.chat_id):
+            reply.dice(3)
+
+        payouts = [bet.bet_type.payout(bet.selection, dice, bet.stake) for bet in game.bets]
+        outcome = f"开 {dice[0]}-{dice[1]}-{dice[2]}"
+        try:
+            results = await self.storage.settle_round(game.chat_id, [
+                (bet.user_id, bet.username, bet.stake, payout,
+                 (payout > 0) if bet.bet_type.tracks_streak(bet.selection) else None, f"{bet.label} {outcome}")
+                for bet, payout in zip(game.bets, payouts)])
+        except Exception as e:
+            logger.error(f"Error in round settlement for chat {game.chat_id}: {str(e)}")
+            await reply.add("本轮结算失败，所有注单已作废，请稍后重试！").send()
+            return
+
+        reply.add(f"🎲 本轮开奖：{dice[0]}-{dice[1]}-{dice[2]} (总和 {sum(dice)})，共 {len(game.bets)} 注")
+        if game.stream is not None:
+            reply.add(f"🔐 本轮种子：{game.stream.seed.hex()}（结果为第 0 次开奖，/fair 查看验证方法）")
+        # 按用户汇总：注数、下注额、派彩、作废注数、最终余额/连胜、是否有大额中奖
+        users = {}
+        for bet, payout, result in zip(game.bets, payouts, results):
+            summary = users.setdefault(bet.user_id, {"name": bet.name, "bets": 0, "stake": 0, "payout": 0,
+                                                     "void": 0, "result": None, "big_win": False})
+            if result is None:
+                summary["void"] += 1
+                continue
+            summary["bets"] += 1
+            summary["stake"] += bet.stake
+            summary["payout"] += payout
+            summary["result"] = result
+            summary["big_win"] = summary["big_win"] or payout >= 500
+        lines = []
+        unlocks = []
+        for user_id, summary in users.items():
+            text = f"{summary['name']}："
+            if summary["bets"]:
+                net = summary["payout"] - summary["stake"]
+                text += f"{summary['bets']} 注共 {summary['stake']} 积分，{'赢' if net >= 0 else '输'} {abs(net)}，" \
+                        f"当前积分 {summary['result'][0]}"
+            if summary["void"]:
+                text += f"{'，' if summary['bets'] else ''}{summary['void']} 注因积分不足作废"
+            lines.append(text)
+            if summary["result"] is None:
+                continue
+            triggers = ("play", "points", "big_win") if summary["big_win"] else ("play", "points")
+            balance, consecutive_wins = summary["result"]
+            try:
+                for msg in await self.achievement_engine.check(user_id, triggers, {"points": balance,
+                                                                                   "consecutive_wins": consecutive_wins}):
+                    unlocks.append(f"{summary['name']} {msg}")
+            except Exception as e:
+                logger.error(f"Error checking achievements for user {user_id}: {str(e)}")
+        for line in lines[:self.max_lines]:
+            reply.add(line)
+        if len(lines) > self.max_lines:
+            reply.add(f"……另有 {len(lines) - self.max_lines} 名玩家")
+        for msg in unlocks:
+            reply.add(msg)
+        await reply.send()
+
+    # 立即开奖所有进行中的轮次（关闭时调用）
+    async def close_all(self):
+        games = list(self._rounds.values())
+        for game in games:
+            game.wake.set()
+        await asyncio.gather(*(game.task for game in games), return_exceptions=True)
@@ -0,0 +1,255 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+from collections import deque
+
+from telegram import Update
+from telegram.ext import Application, TypeHandler
+
+from ratelimit import parse_limit
+
+logger = logging.getLogger(__name__)
+
+
+# 分片键：按用户分片，保证同一用户的更新总是由同一个进程按顺序处理；没有用户时按会话分片
+def shard_key(update):
+    if update.effective_user is not None:
+        return update.effective_user.id
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    return update.update_id
+
+
+# 群级限额按进程数平分：同一群的用户分散在各个工作进程中。容量不足 1 时改为延长周期，保持平均速率
+def split_limit(value, workers):
+    capacity, period = parse_limit(value)
+    capacity /= workers
+    if capacity < 1:
+        period /= capacity
+        capacity = 1
+    return f"{capacity:g}/{period:g}"
+
+
+# 前端进程到某个工作进程的有序发送：队列满时更新先进入本地积压，由唯一的发送任务按顺序在线程里阻塞写入，
+# 保证同一分片内的顺序；积压达到 max_backlog 时 send 等待，把背压传回前端的更新处理。
+# 工作进程退出后 abandon() 丢弃积压，send 不再排队
+class _ShardSender:
+    def __init__(self, worker_queue, max_backlog):
+        self.worker_queue = worker_queue
+        self.max_backlog = max_backlog
+        self.backlog = deque()
+        self.closing = False
+        self.dead = False
+        self._ready = asyncio.Event()
+        self._room = asyncio.Event()
+        self._room.set()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def send(self, data):
+        if self.dead:
+            return
+        # 没有积压时直接写入；有积压时必须排在后面，否则会越过更早的更新
+        if not self.backlog:
+            try:
+                self.worker_queue.put_nowait(data)
+                return
+            except queue.Full:
+                pass
+        self.backlog.append(data)
+        self._ready.set()
+        if len(self.backlog) >= self.max_backlog:
+            self._room.clear()
+        await self._room.wait()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while (self.backlog or not self.closing) and not self.dead:
+            if not self.backlog:
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+            # 写入完成后才出队，写入期间 send 看到积压非空，不会走直接写入；
+            # 带超时写入，工作进程退出时不会永久阻塞在已满的队列上
+            try:
+                await loop.run_in_executor(None, self.worker_queue.put, self.backlog[0], True, 1.0)
+            except queue.Full:
+                continue
+            self.backlog.popleft()
+            if len(self.backlog) < self.max_backlog:
+                self._room.set()
+
+    # 写完积压后结束发送任务
+    async def close(self):
+        self.closing = True
+        self._ready.set()
+        await self._task
+
+    # 工作进程已退出：丢弃积压并放行等待中的 send，返回丢弃的更新数
+    def abandon(self):
+        self.dead = True
+        dropped = len(self.backlog)
+        self.backlog.clear()
+        self._ready.set()
+        self._room.set()
+        return dropped
+
+
+# 多进程模式：前端进程只负责接收更新（轮询或 webhook），按 user_id 哈希转发给 N 个工作进程；
+# 工作进程各自运行完整的处理器，通过 WAL 模式的 SQLite 共享数据，余额一致性由存储层的事务和条件更新保证。
+# 群成员变动（升降管理员）广播给所有工作进程，各自更新管理员缓存。
+# 任一工作进程意外退出时记录错误并停止前端（由进程管理器重启整个服务），不再向它排队更新
+# request_factory 用于替换 HTTP 请求层（离线测试），需可被 pickle，例如 fake_telegram.FakeRequest
+class ShardRouter:
+    def __init__(self, token, workers, max_queue=10000, request_factory=None):
+        self.token = token
+        self.workers = workers
+        self.request_factory = request_factory
+        self._ctx = multiprocessing.get_context("spawn")
+        self.max_queue = max_queue
+        self._queues = [self._ctx.Queue(max_queue) for _ in range(workers)]
+        self._processes = []
+        self._senders = []
+        self._watchdog = None
+        self._post_init = None
+        self._post_shutdown = None
+
+    def start(self):
+        for index, worker_queue in enumerate(self._queues):
+            process = self._ctx.Process(target=worker_main, args=(index, self.workers, worker_queue, self.token,
+                                                                           self.request_factory),
+                                        name=f"bot-worker-{index}", daemon=True)
+            process.start()
+            self._processes.append(process)
+        logger.info(f"Started {self.workers} worker processes")
+
+    async def route(self, update: Update, context):
+        data = update.to_dict()
+        if update.chat_member is not None or update.my_chat_member is not None:
+            await asyncio.gather(*(sender.send(data) for sender in self._senders))
+            return
+        await self._senders[shard_key(update) % self.workers].send(data)
+
+    # 定期检查工作进程是否存活
+    async def _watch(self, application, interval=1.0):
+        while True:
+            await asyncio.sleep(interval)
+            for process, sender in zip(self._processes, self._senders):
+                if not sender.dead and not process.is_alive():
+                    dropped = sender.abandon()
+                    logger.error(f"Worker {process.name} exited unexpectedly with code {process.exitcode}, "
+                                 f"dropped {dropped} queued updates; stopping")
+                    application.stop_running()
+
+    # 通知工作进程处理完剩余更新后退出；已退出的工作进程跳过
+    def stop(self, timeout=30):
+        for worker_queue, process in zip(self._queues, self._processes):
+            while process.is_alive():
+                try:
+                    worker_queue.put(None, timeout=1.0)
+                    break
+                except queue.Full:
+                    pass
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning(f"Worker {process.name} did not exit in {timeout}s, terminating")
+                process.terminate()
+        self._processes.clear()
+
+    async def _on_startup(self, application):
+        if self._post_init is not None:
+            await self._post_init(application)
+        self._senders = [_ShardSender(worker_queue, self.max_queue) for worker_queue in self._queues]
+        self.start()
+        self._watchdog = asyncio.get_running_loop().create_task(self._watch(application))
+
+    async def _on_shutdown(self, application):
+        if self._watchdog is not None:
+            self._watchdog.cancel()
+            self._watchdog = None
+        # 先把本地积压的更新交给工作进程，再发送退出信号
+        await asyncio.gather(*(sender.close() for sender in self._senders))
+        await asyncio.get_running_loop().run_in_executor(None, self.stop)
+        if self._post_shutdown is not None:
+            await self._post_shutdown(application)
+
+    # 前端进程的 Application：唯一的处理器把所有更新转发给工作进程；
+    # post_init 在启动工作进程之前执行（如数据库迁移），post_shutdown 在工作进程退出之后执行
+    def build_front_application(self, post_init=None, post_shutdown=None):
+        self._post_init = post_init
+        self._post_shutdown = post_shutdown
+        builder = Application.builder().token(self.token).concurrent_updates(True) \
+            .post_init(self._on_startup).post_shutdown(self._on_shutdown)
+        if self.request_factory is not None:
+            request = self.request_factory()
+            builder = builder.request(request).get_updates_request(request)
+        app = builder.build()
+        app.add_handler(TypeHandler(Update, self.route))
+        return app
+
+
+def worker_main(index, workers, worker_queue, token, request_factory=None):
+    # 群级缓存在进程间不共享，出站限额按进程数平分。同一群的用户分散在各个工作进程中，
+    # 群级的入站限流（RATE_LIMIT_CHAT）和群出站限额（RATE_LIMIT_GROUP_CHAT）也按进程数平分；
+    # 私聊按用户分片只落在一个进程，不需要平分
+    os.environ.setdefault("SHARED_CACHE_TTL", "5")
+    os.environ["RATE_LIMIT_OUTGOING"] = split_limit(os.getenv("RATE_LIMIT_OUTGOING", "30/1"), workers)
+    os.environ["RATE_LIMIT_CHAT"] = split_limit(os.getenv("RATE_LIMIT_CHAT", "30/10"), workers)
+    os.environ["RATE_LIMIT_GROUP_CHAT"] = split_limit(os.getenv("RATE_LIMIT_GROUP_CHAT", "20/60"), workers)
+    # 承诺-揭示模式下每个工作进程一条结果流
+    os.environ["WORKER_INDEX"] = str(index)
+    # 每个工作进程各自提供 /metrics，端口依次为 METRICS_PORT + index
+    if os.getenv("METRICS_PORT"):
+        os.environ["METRICS_PORT"] = str(int(os.environ["METRICS_PORT"]) + index)
+    asyncio.run(_worker(index, worker_queue, token, request_factory))
+
+
+async def _worker(index, worker_queue, token, request_factory, max_inflight=256):
+    import bot
+
+    app = bot.build_application(token, request=request_factory() if request_factory else None, worker=True)
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+    logger.info(f"Worker {index} ready")
+
+    loop = asyncio.get_running_loop()
+    inflight = asyncio.Semaphore(max_inflight)
+    # 每个分片键最后一个处理任务，新任务排在它后面，保证同一用户内有序、不同用户间并发
+    tails = {}
+
+    async def process(update, previous):
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            await app.process_update(update)
+        finally:
+            inflight.release()
+
+    def done(key, task):
+        if tails.get(key) is task:
+            del tails[key]
+
+    try:
+        while True:
+            data = await loop.run_in_executor(None, worker_queue.get)
+            if data is None:
+                break
+            update = Update.de_json(data, app.bot)
+            key = shard_key(update)
+            await inflight.acquire()
+            task = asyncio.create_task(process(update, tails.get(key)))
+            tails[key] = task
+            task.add_done_callback(lambda t, key=key: done(key, t))
+        await asyncio.gather(*tails.values(), return_exceptions=True)
+    finally:
+        await app.stop()
+        if app.post_stop:
+            await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+        logger.info(f"Worker {index} stopped")
@@ -0,0 +1,90 @@
+import asyncio
+import hashlib
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+# 指令菜单的哈希（命令名和描述），菜单不变时无需重新 set_my_commands
+def commands_hash(commands):
+    data = json.dumps([[command.command, command.description] for command in commands], ensure_ascii=False)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+# 启动后在后台执行的任务，不阻塞开始接收更新：
+# 同步指令菜单（哈希与上次设置的相同则跳过，按 bot 分别记录）；
+# 预热缓存：按最近的积分流水找出活跃的群和用户，加载全局/群排行榜、群设置、群管理员和用户成就
+class StartupTasks:
+    def __init__(self, storage, commands, leaderboard, fast_mode, round_manager, achievement_engine, admin_cache,
+                 chats=20, users=1000, ledger_rows=5000):
+        self.storage = storage
+        self.commands = commands
+        self.leaderboard = leaderboard
+        self.fast_mode = fast_mode
+        self.round_manager = round_manager
+        self.achievement_engine = achievement_engine
+        self.admin_cache = admin_cache
+        self.chats = chats
+        self.users = users
+        self.ledger_rows = ledger_rows
+        self._task = None
+
+    # 返回是否调用了 set_my_commands
+    async def sync_commands(self, bot):
+        key = f"commands_hash:{bot.id}"
+        digest = commands_hash(self.commands)
+        if await self.storage.get_bot_setting(key) == digest:
+            logger.info("Bot commands unchanged, skipping set_my_commands")
+            return False
+        await bot.set_my_commands(self.commands)
+        await self.storage.set_bot_setting(key, digest)
+        logger.info("Bot commands set successfully")
+        return True
+
+    async def warm(self, bot):
+        started = time.monotonic()
+        chats, users = await self.storage.recent_activity(self.ledger_rows)
+        chats = chats[:self.chats]
+        await self.leaderboard.page(1)
+        for chat_id in chats:
+            try:
+                await self.fast_mode.enabled(chat_id)
+                await self.round_manager.seconds(chat_id)
+                await self.leaderboard.page(1, chat_id)
+                await self.admin_cache.admins(bot, chat_id)
+            except Exception as e:
+                logger.warning(f"Error warming caches for chat {chat_id}: {str(e)}")
+        loaded = await self.achievement_engine.preload(users[:self.users])
+        logger.info(f"Warmed caches for {len(chats)} chats and {loaded} users in {time.monotonic() - started:.2f}s")
+
+    async def _run(self, bot, menu, warm):
+        if menu:
+            try:
+                await self.sync_commands(bot)
+            except Exception as e:
+                logger.error(f"Error setting bot commands: {str(e)}")
+        if warm:
+            try:
+                await self.warm(bot)
+            except Exception as e:
+                logger.error(f"Error warming caches: {str(e)}")
+
+    def start(self, bot, menu=True, warm=True):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run(bot, menu, warm))
+
+    # 等待后台任务完成（基准测试在计时前调用）
+    async def join(self):
+        if self._task is not None:
+            await asyncio.shield(self._task)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
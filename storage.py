@@ -0,0 +1,526 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from metrics import SampledLog
+from migrations import TABLES, migrate_sqlite
+
+logger = logging.getLogger(__name__)
+# 每次积分变动的日志（事务提交后记录），级别和采样比例由 bot.py 按 POINTS_LOG_LEVEL / POINTS_LOG_SAMPLE 配置
+points_log = SampledLog(logger)
+
+# 结算时余额不足（条件更新未命中）
+class InsufficientPoints(Exception):
+    pass
+
+
+# 存储后端的公共部分：积分变动监听器。后端需实现下列方法（均为 async），参见 Storage（SQLite）
+# 和 storage_pg.PostgresStorage：
+# start / close / migrate / get_points / update_points / load_activity / flush_activity / settle_bet /
+# load_unlocked / load_unlocked_many / save_unlocks / find_user_by_username / grant_all / get_fast_mode /
+# set_fast_mode / get_round_seconds / set_round_seconds / settle_round / top_users / rank / history / snapshot /
+# compact_ledger / audit / export_rows / import_rows / recent_activity / get_bot_setting / set_bot_setting /
+# load_dice_seeds / save_dice_seeds
+# 所有积分变动都在同一事务中追加 ledger 流水（每个事务一次批量写入），users.points 是流水的实时汇总
+class BaseStorage:
+    # 计入监控指标的异步方法
+    OPERATIONS = ("get_points", "update_points", "load_activity", "flush_activity", "settle_bet", "load_unlocked",
+                  "save_unlocks", "find_user_by_username", "grant_all", "get_fast_mode", "set_fast_mode",
+                  "get_round_seconds", "set_round_seconds", "settle_round", "top_users", "rank", "history",
+                  "snapshot", "compact_ledger", "audit", "import_rows", "load_unlocked_many", "recent_activity",
+                  "get_bot_setting", "set_bot_setting", "load_dice_seeds", "save_dice_seeds")
+
+    def __init__(self):
+        self._listeners = []
+
+    # 注册积分变动监听器：listener(changes, members)，changes 为 [(user_id, username, points)]，None 表示大范围变动；
+    # members 为新加入的 (chat_id, user_id)
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def _notify(self, changes, members=()):
+        for listener in self._listeners:
+            try:
+                listener(changes, members)
+            except Exception as e:
+                logger.error(f"Error in points listener: {str(e)}")
+
+    # 在事件循环中打开连接（连接池等），启动时调用
+    async def start(self):
+        pass
+
+
+# 结算时连胜的更新方式：None 不变，True 连胜 +1，False 清零
+STREAK_SQL = {None: "consecutive_wins", True: "consecutive_wins + 1", False: "0"}
+
+# 流水类型
+LEDGER_REASONS = {"opening": "期初余额", "chat": "发言", "bet": "下注", "round": "轮次下注", "achievement": "成就奖励",
+                  "admin": "管理员加分", "grant": "全员加分"}
+
+
+def ledger_time():
+    return datetime.now().isoformat(timespec="seconds")
+
+
+# 按 DATABASE_URL 选择后端：postgres:// 或 postgresql:// 使用 PostgreSQL，其余视为 SQLite 文件路径
+def create_storage(url):
+    if url.startswith(("postgres://", "postgresql://")):
+        from storage_pg import PostgresStorage
+        return PostgresStorage(url)
+    if url.startswith("sqlite:///"):
+        url = url[len("sqlite:///"):]
+    return Storage(url)
+
+
+# SQLite 连接池：读操作分散在多个读线程，写操作串行在单一写线程，全部通过 await 调用，不阻塞事件循环
+class Storage(BaseStorage):
+    def __init__(self, path="points.db", readers=4):
+        super().__init__()
+        self.path = path
+        self._local = threading.local()
+        self._conns = []
+        self._conns_lock = threading.Lock()
+        self._reader = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-read")
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+        # 语句计数，track_queries() 开启后为 Counter（queries / commits）
+        self.query_stats = None
+
+    def _connect(self):
+        # isolation_level=None：由我们显式控制事务；cached_statements 让每个线程的连接复用预编译语句
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, cached_statements=256)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        if self.query_stats is not None:
+            conn.set_trace_callback(self._trace)
+        with self._conns_lock:
+            self._conns.append(conn)
+        return conn
+
+    # 统计执行的 SQL 语句数和事务提交数（压测用），对已打开和之后打开的连接都生效
+    def track_queries(self):
+        self.query_stats = Counter()
+        with self._conns_lock:
+            for conn in self._conns:
+                conn.set_trace_callback(self._trace)
+        return self.query_stats
+
+    def _trace(self, statement):
+        keyword = statement.lstrip()[:8].upper()
+        if keyword.startswith("COMMIT"):
+            self.query_stats["commits"] += 1
+        elif not keyword.startswith(("BEGIN", "ROLLBACK", "PRAGMA")):
+            self.query_stats["queries"] += 1
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def _run_read(self, fn, args):
+        return fn(self._conn().cursor(), *args)
+
+    def _run_write(self, fn, args):
+        conn = self._conn()
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(c, *args)
+        except BaseException:
+            c.execute("ROLLBACK")
+            raise
+        c.execute("COMMIT")
+        return result
+
+    # 在读线程中执行 fn(cursor, *args)
+    async def read(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._reader, self._run_read, fn, args)
+
+    # 在写线程中以单个事务执行 fn(cursor, *args)
+    async def write(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer, self._run_write, fn, args)
+
+    # 执行尚未应用的结构迁移，返回应用的版本号列表
+    async def migrate(self):
+        return await self.write(migrate_sqlite)
+
+    async def close(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._close)
+
+    def _close(self):
+        self._reader.shutdown(wait=True)
+        self._writer.shutdown(wait=True)
+        with self._conns_lock:
+            for conn in self._conns:
+                conn.close()
+            self._conns.clear()
+
+    # 按主键顺序分批导出整表，每批为行元组列表，列顺序见 migrations.TABLES
+    async def export_rows(self, table, batch_size=1000):
+        columns = ", ".join(TABLES[table])
+
+        def _batch(c, after):
+            rows = c.execute(f"SELECT rowid, {columns} FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                             (after, batch_size)).fetchall()
+            return (rows[-1][0] if rows else after), [row[1:] for row in rows]
+        after = 0
+        while True:
+            after, rows = await self.read(_batch, after)
+            if not rows:
+                return
+            yield rows
+
+    # 批量导入一批行，主键已存在的行跳过，返回实际写入的行数
+    async def import_rows(self, table, rows):
+        columns = TABLES[table]
+
+        def _import(c):
+            before = c.connection.total_changes
+            c.executemany(f"""INSERT INTO {table} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})
+                              ON CONFLICT DO NOTHING""", rows)
+            return c.connection.total_changes - before
+        count = await self.write(_import)
+        self._notify(None)
+        return count
+
+    async def get_points(self, user_id):
+        def _get(c):
+            row = c.execute("SELECT points FROM users WHERE user_id = ?", (user_id,)).fetchone()
+            return row[0] if row else 0
+        return await self.read(_get)
+
+    # 返回变动后的积分；reason / details 记入流水
+    async def update_points(self, user_id, username, points_change, reason="admin", details=None):
+        points = await self.write(_add_points, user_id, username, points_change, reason, details)
+        points_log("points_changed", user=user_id, delta=points_change, balance=points)
+        self._notify([(user_id, username, points)])
+        return points
+
+    # 发言缓冲首次加载：返回 (last_message, 活跃分子进度)
+    async def load_activity(self, user_id):
+        def _load(c):
+            row = c.execute("""SELECT u.last_message, a.progress FROM users u
+                               LEFT JOIN achievements a ON a.user_id = u.user_id AND a.achievement_name = ?
+                               WHERE u.user_id = ?""", ("活跃分子", user_id)).fetchone()
+            if row is None:
+                return None, 0
+            return (datetime.fromisoformat(row[0]) if row[0] else None), (row[1] or 0)
+        return await self.read(_load)
+
+    # 批量写入发言积分：rows 为 (user_id, username, points, activity, last_message)，members 为新出现的 (chat_id, user_id)
+    # 返回 [(user_id, 新积分)]
+    async def flush_activity(self, rows, members=()):
+        def _flush(c):
+            balances = []
+            for user_id, username, points, activity, last_message in rows:
+                c.execute("""INSERT INTO users (user_id, username, points, last_message) VALUES (?, ?, ?, ?)
+                             ON CONFLICT(user_id) DO UPDATE SET points = points + excluded.points,
+                             last_message = excluded.last_message, username = COALESCE(excluded.username, username)
+                             RETURNING points""",
+                          (user_id, username, points, last_message))
+                balances.append((user_id, c.fetchone()[0]))
+            now = ledger_time()
+            c.executemany(LEDGER_INSERT, [(row[0], None, row[2], balance, "chat", None, now)
+                                          for row, (_, balance) in zip(rows, balances) if row[2]])
+            c.executemany("""INSERT INTO achievements (user_id, achievement_name, progress) VALUES (?, ?, ?)
+                             ON CONFLICT(user_id, achievement_name) DO UPDATE SET progress = progress + excluded.progress""",
+                          [(user_id, "活跃分子", activity) for user_id, _, _, activity, _ in rows])
+            # 只通知实际新加入的成员：已在群中的成员不影响群排行榜缓存
+            joined = [member for member in members
+                      if c.execute("INSERT OR IGNORE INTO chat_members (chat_id, user_id) VALUES (?, ?)",
+                                   member).rowcount > 0]
+            logger.info(f"Flushed chat activity for {len(rows)} users")
+            return balances, joined
+        balances, joined = await self.write(_flush)
+        usernames = {row[0]: row[1] for row in rows}
+        self._notify([(user_id, usernames[user_id], points) for user_id, points in balances], joined)
+        return balances
+
+    # 下注结算：扣注、派彩、连胜在同一事务完成；余额校验由条件 UPDATE 保证，并发下注不会透支
+    # streak：None 不变，True 连胜 +1，False 清零；details 为流水中的注单说明。返回 (新余额, 连胜次数)
+    async def settle_bet(self, user_id, username, stake, payout, streak=None, chat_id=None, details=None):
+        streak_sql = STREAK_SQL[streak]
+
+        def _settle(c):
+            row = c.execute(f"""UPDATE users SET points = points - ? + ?, consecutive_wins = {streak_sql},
+                               username = COALESCE(?, username)
+                               WHERE user_id = ? AND points >= ? RETURNING points, consecutive_wins""",
+                            (stake, payout, username, user_id, stake)).fetchone()
+            if row is None:
+                raise InsufficientPoints(user_id)
+            c.execute(LEDGER_INSERT, (user_id, chat_id, payout - stake, row[0], "bet", details, ledger_time()))
+            joined = False
+            if chat_id is not None:
+                joined = c.execute("INSERT OR IGNORE INTO chat_members (chat_id, user_id) VALUES (?, ?)",
+                                   (chat_id, user_id)).rowcount > 0
+            return row[0], row[1], joined
+        balance, consecutive_wins, joined = await self.write(_settle)
+        points_log("bet_settled", user=user_id, stake=stake, payout=payout, balance=balance)
+        self._notify([(user_id, username, balance)], [(chat_id, user_id)] if joined else ())
+        return balance, consecutive_wins
+
+    # 一轮下注批量结算：全部注单在同一个事务中依次扣注派彩，余额不足的注单作废
+    # bets 为 [(user_id, username, stake, payout, streak, details)]，返回与 bets 一一对应的 (新余额, 连胜次数)，作废为 None
+    async def settle_round(self, chat_id, bets):
+        def _settle(c):
+            results = []
+            entries = []
+            now = ledger_time()
+            for user_id, username, stake, payout, streak, details in bets:
+                row = c.execute(f"""UPDATE users SET points = points - ? + ?, consecutive_wins = {STREAK_SQL[streak]},
+                                   username = COALESCE(?, username)
+                                   WHERE user_id = ? AND points >= ? RETURNING points, consecutive_wins""",
+                                (stake, payout, username, user_id, stake)).fetchone()
+                results.append(tuple(row) if row else None)
+                if row:
+                    entries.append((user_id, chat_id, payout - stake, row[0], "round", details, now))
+            c.executemany(LEDGER_INSERT, entries)
+            joined = []
+            for user_id in {bet[0] for bet, result in zip(bets, results) if result}:
+                if c.execute("INSERT OR IGNORE INTO chat_members (chat_id, user_id) VALUES (?, ?)",
+                             (chat_id, user_id)).rowcount > 0:
+                    joined.append((chat_id, user_id))
+            return results, joined
+        results, joined = await self.write(_settle)
+        for (user_id, _, stake, payout, _, _), result in zip(bets, results):
+            if result:
+                points_log("bet_settled", user=user_id, stake=stake, payout=payout, balance=result[0])
+        self._notify([(bet[0], bet[1], result[0]) for bet, result in zip(bets, results) if result], joined)
+        return results
+
+    async def load_unlocked(self, user_id):
+        def _load(c):
+            rows = c.execute("SELECT achievement_name FROM achievements WHERE user_id = ? AND unlocked = 1", (user_id,))
+            return {name for (name,) in rows}
+        return await self.read(_load)
+
+    # 批量读取多个用户已解锁的成就，返回 {user_id: 名称集合}（没有解锁记录的用户也在结果中）
+    async def load_unlocked_many(self, user_ids):
+        def _load(c):
+            unlocked = {user_id: set() for user_id in user_ids}
+            for start in range(0, len(user_ids), 500):
+                batch = user_ids[start:start + 500]
+                rows = c.execute(f"""SELECT user_id, achievement_name FROM achievements
+                                     WHERE unlocked = 1 AND user_id IN ({",".join("?" * len(batch))})""", batch)
+                for user_id, name in rows:
+                    unlocked[user_id].add(name)
+            return unlocked
+        return await self.read(_load)
+
+    # 批量写入解锁记录并发放奖励；已解锁的成就不会重复发奖，返回 {实际解锁的名称: 发奖后积分}
+    async def save_unlocks(self, user_id, unlocks):
+        def _save(c):
+            credited = {}
+            for name, reward in unlocks:
+                c.execute("""INSERT INTO achievements (user_id, achievement_name, unlocked) VALUES (?, ?, 1)
+                             ON CONFLICT(user_id, achievement_name) DO UPDATE SET unlocked = 1 WHERE unlocked = 0""",
+                          (user_id, name))
+                if c.rowcount:
+                    points = _add_points(c, user_id, None, reward, "achievement", name)
+                    credited[name] = points
+            return credited
+        credited = await self.write(_save)
+        rewards = dict(unlocks)
+        for name, points in credited.items():
+            points_log("points_changed", user=user_id, delta=rewards[name], balance=points)
+        if credited:
+            self._notify([(user_id, None, max(credited.values()))])
+        return credited
+
+    async def find_user_by_username(self, username):
+        def _find(c):
+            row = c.execute("SELECT user_id FROM users WHERE username = ?", (username,)).fetchone()
+            return row[0] if row else None
+        return await self.read(_find)
+
+    # 全员加分：一条 UPDATE 完成加分，积分门槛成就用集合查询一次性判定并发奖
+    # thresholds 为 [(成就名, 奖励, 门槛)]，返回 (用户数, {成就名: [新解锁的 user_id]})；加 0 分时什么也不做，返回 (0, {})
+    async def grant_all(self, points_change, thresholds=()):
+        if not points_change:
+            return 0, {}
+        def _grant(c):
+            count = c.execute("UPDATE users SET points = points + ?", (points_change,)).rowcount
+            now = ledger_time()
+            c.execute("""INSERT INTO ledger (user_id, delta, balance, reason, created_at)
+                         SELECT user_id, ?, points, 'grant', ? FROM users""", (points_change, now))
+            unlocked = {}
+            c.execute("CREATE TEMP TABLE IF NOT EXISTS bulk_unlocked (user_id INTEGER PRIMARY KEY)")
+            for name, reward, min_points in thresholds:
+                c.execute("DELETE FROM bulk_unlocked")
+                c.execute("""INSERT INTO bulk_unlocked (user_id)
+                             SELECT u.user_id FROM users u
+                             LEFT JOIN achievements a ON a.user_id = u.user_id AND a.achievement_name = ?
+                             WHERE u.points >= ? AND COALESCE(a.unlocked, 0) = 0""", (name, min_points))
+                c.execute("""INSERT INTO achievements (user_id, achievement_name, unlocked)
+                             SELECT user_id, ?, 1 FROM bulk_unlocked WHERE true
+                             ON CONFLICT(user_id, achievement_name) DO UPDATE SET unlocked = 1""", (name,))
+                c.execute("UPDATE users SET points = points + ? WHERE user_id IN (SELECT user_id FROM bulk_unlocked)", (reward,))
+                c.execute("""INSERT INTO ledger (user_id, delta, balance, reason, details, created_at)
+                             SELECT user_id, ?, points, 'achievement', ?, ? FROM users
+                             WHERE user_id IN (SELECT user_id FROM bulk_unlocked)""", (reward, name, now))
+                unlocked[name] = [user_id for (user_id,) in c.execute("SELECT user_id FROM bulk_unlocked")]
+            logger.info(f"Granted {points_change} points to {count} users")
+            return count, unlocked
+        result = await self.write(_grant)
+        self._notify(None)
+        return result
+
+    async def get_fast_mode(self, chat_id):
+        def _get(c):
+            row = c.execute("SELECT fast_mode FROM chat_settings WHERE chat_id = ?", (chat_id,)).fetchone()
+            return bool(row and row[0])
+        return await self.read(_get)
+
+    async def set_fast_mode(self, chat_id, enabled):
+        def _set(c):
+            c.execute("""INSERT INTO chat_settings (chat_id, fast_mode) VALUES (?, ?)
+                         ON CONFLICT(chat_id) DO UPDATE SET fast_mode = excluded.fast_mode""", (chat_id, int(enabled)))
+        await self.write(_set)
+
+    # 下注轮次时长（秒），0 表示关闭轮次模式
+    async def get_round_seconds(self, chat_id):
+        def _get(c):
+            row = c.execute("SELECT round_seconds FROM chat_settings WHERE chat_id = ?", (chat_id,)).fetchone()
+            return (row and row[0]) or 0
+        return await self.read(_get)
+
+    async def set_round_seconds(self, chat_id, seconds):
+        def _set(c):
+            c.execute("""INSERT INTO chat_settings (chat_id, round_seconds) VALUES (?, ?)
+                         ON CONFLICT(chat_id) DO UPDATE SET round_seconds = excluded.round_seconds""", (chat_id, seconds))
+        await self.write(_set)
+
+    # 最近的 limit 条积分流水涉及的群和用户，按最近活跃排序，用于启动时预热缓存
+    async def recent_activity(self, limit=5000):
+        def _recent(c):
+            rows = c.execute("SELECT chat_id, user_id FROM ledger ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+            chats = list(dict.fromkeys(chat_id for chat_id, _ in rows if chat_id is not None and chat_id < 0))
+            return chats, list(dict.fromkeys(user_id for _, user_id in rows))
+        return await self.read(_recent)
+
+    async def get_bot_setting(self, name):
+        def _get(c):
+            row = c.execute("SELECT value FROM bot_settings WHERE name = ?", (name,)).fetchone()
+            return row[0] if row else None
+        return await self.read(_get)
+
+    async def set_bot_setting(self, name, value):
+        def _set(c):
+            c.execute("""INSERT INTO bot_settings (name, value) VALUES (?, ?)
+                         ON CONFLICT(name) DO UPDATE SET value = excluded.value""", (name, value))
+        await self.write(_set)
+
+    # 承诺-揭示模式的种子，返回 [(shard, 当前种子, 已公布的种子, 其开奖次数)]
+    async def load_dice_seeds(self, chat_id):
+        def _load(c):
+            return c.execute("""SELECT shard, seed, revealed_seed, revealed_draws FROM dice_seeds
+                                WHERE chat_id = ? ORDER BY shard""", (chat_id,)).fetchall()
+        return await self.read(_load)
+
+    # rows 为 (chat_id, shard, seed, revealed_seed, revealed_draws)，整行覆盖
+    async def save_dice_seeds(self, rows):
+        def _save(c):
+            c.executemany("""INSERT INTO dice_seeds (chat_id, shard, seed, revealed_seed, revealed_draws)
+                             VALUES (?, ?, ?, ?, ?) ON CONFLICT(chat_id, shard) DO UPDATE SET seed = excluded.seed,
+                             revealed_seed = excluded.revealed_seed, revealed_draws = excluded.revealed_draws""", rows)
+        await self.write(_save)
+
+    # 排行榜：chat_id 为 None 时为全局榜，返回 [(user_id, username, points)]
+    async def top_users(self, limit=5, offset=0, chat_id=None):
+        def _top(c):
+            if chat_id is None:
+                return c.execute("""SELECT user_id, username, points FROM users
+                                    ORDER BY points DESC, user_id LIMIT ? OFFSET ?""", (limit, offset)).fetchall()
+            return c.execute("""SELECT u.user_id, u.username, u.points FROM chat_members m
+                                JOIN users u ON u.user_id = m.user_id WHERE m.chat_id = ?
+                                ORDER BY u.points DESC, u.user_id LIMIT ? OFFSET ?""", (chat_id, limit, offset)).fetchall()
+        return await self.read(_top)
+
+    # 用户名次（走 points 索引计数，不排序全表），返回 (名次, 积分)；用户不存在或不在该群的榜上时返回 None
+    async def rank(self, user_id, chat_id=None):
+        def _rank(c):
+            if chat_id is None:
+                row = c.execute("SELECT points FROM users WHERE user_id = ?", (user_id,)).fetchone()
+            else:
+                row = c.execute("""SELECT u.points FROM chat_members m JOIN users u ON u.user_id = m.user_id
+                                   WHERE m.chat_id = ? AND m.user_id = ?""", (chat_id, user_id)).fetchone()
+            if row is None:
+                return None
+            points = row[0]
+            if chat_id is None:
+                ahead = c.execute("""SELECT COUNT(*) FROM users
+                                     WHERE points > ? OR (points = ? AND user_id < ?)""",
+                                  (points, points, user_id)).fetchone()[0]
+            else:
+                ahead = c.execute("""SELECT COUNT(*) FROM chat_members m JOIN users u ON u.user_id = m.user_id
+                                     WHERE m.chat_id = ? AND (u.points > ? OR (u.points = ? AND u.user_id < ?))""",
+                                  (chat_id, points, points, user_id)).fetchone()[0]
+            return ahead + 1, points
+        return await self.read(_rank)
+
+    # 用户积分流水，新的在前（走 (user_id, id) 索引），返回 [(created_at, delta, balance, reason, details)]
+    async def history(self, user_id, limit=10, offset=0):
+        def _history(c):
+            return c.execute("""SELECT created_at, delta, balance, reason, details FROM ledger
+                                WHERE user_id = ? ORDER BY id DESC LIMIT ? OFFSET ?""",
+                             (user_id, limit, offset)).fetchall()
+        return await self.read(_history)
+
+    # 增量快照：把上次快照之后有流水的用户的当前余额写入 balance_snapshots，返回 (快照流水号, 更新用户数)
+    async def snapshot(self):
+        def _snapshot(c):
+            last = c.execute("SELECT COALESCE(MAX(ledger_id), 0) FROM ledger_snapshots").fetchone()[0]
+            mark = c.execute("SELECT COALESCE(MAX(id), 0) FROM ledger").fetchone()[0]
+            if mark == last:
+                return mark, 0
+            count = c.execute("""INSERT INTO balance_snapshots (user_id, points, ledger_id)
+                                 SELECT user_id, points, ? FROM users
+                                 WHERE user_id IN (SELECT DISTINCT user_id FROM ledger WHERE id > ?)
+                                 ON CONFLICT(user_id) DO UPDATE SET points = excluded.points,
+                                 ledger_id = excluded.ledger_id""", (mark, last)).rowcount
+            c.execute("INSERT INTO ledger_snapshots (ledger_id, users, created_at) VALUES (?, ?, ?)",
+                      (mark, count, ledger_time()))
+            return mark, count
+        return await self.write(_snapshot)
+
+    # 删除已被快照覆盖、且早于 before（ISO 时间字符串）的流水，返回删除行数；需要保留时先用 dbtool export 归档
+    async def compact_ledger(self, before):
+        def _compact(c):
+            mark = c.execute("SELECT COALESCE(MAX(ledger_id), 0) FROM ledger_snapshots").fetchone()[0]
+            return c.execute("DELETE FROM ledger WHERE id <= ? AND created_at < ?", (mark, before)).rowcount
+        return await self.write(_compact)
+
+    # 对账：余额应等于快照余额加上快照之后的流水；返回不一致的 [(user_id, points, 按流水应有的积分)]
+    async def audit(self, user_id=None, limit=100):
+        def _audit(c):
+            return c.execute(f"""SELECT user_id, points, expected FROM (
+                                     SELECT u.user_id, u.points, COALESCE(s.points, 0) + COALESCE(
+                                         (SELECT SUM(l.delta) FROM ledger l
+                                          WHERE l.user_id = u.user_id AND l.id > COALESCE(s.ledger_id, 0)), 0) AS expected
+                                     FROM users u LEFT JOIN balance_snapshots s ON s.user_id = u.user_id
+                                     {"WHERE u.user_id = ?" if user_id is not None else ""}
+                                 ) WHERE points != expected LIMIT ?""",
+                             ((user_id, limit) if user_id is not None else (limit,))).fetchall()
+        return await self.read(_audit)
+
+LEDGER_INSERT = """INSERT INTO ledger (user_id, chat_id, delta, balance, reason, details, created_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)"""
+
+
+# 加减积分并记流水；用 UPSERT 保留 last_message / consecutive_wins，username 为空时不覆盖
+def _add_points(c, user_id, username, points_change, reason, details=None):
+    c.execute("""INSERT INTO users (user_id, username, points) VALUES (?, ?, ?)
+                 ON CONFLICT(user_id) DO UPDATE SET points = points + excluded.points,
+                 username = COALESCE(excluded.username, username) RETURNING points""",
+              (user_id, username, points_change))
+    points = c.fetchone()[0]
+    c.execute(LEDGER_INSERT, (user_id, None, points_change, points, reason, details, ledger_time()))
+    return points
@@ -0,0 +1,430 @@
+import logging
+from datetime import datetime
+
+from migrations import PRIMARY_KEYS, TABLES, migrate_postgres
+from storage import STREAK_SQL, BaseStorage, InsufficientPoints, ledger_time, points_log
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+logger = logging.getLogger(__name__)
+
+
+# asyncpg 的 execute 返回状态字符串，例如 "UPDATE 12"、"INSERT 0 1"
+def _rowcount(status):
+    return int(status.rsplit(" ", 1)[-1])
+
+
+# PostgreSQL 后端：asyncpg 连接池，语句由 asyncpg 自动预编译缓存；接口和语义与 SQLite 的 Storage 一致，
+# 多个进程/实例可以共享同一个数据库
+class PostgresStorage(BaseStorage):
+    def __init__(self, dsn, min_size=1, max_size=10):
+        if asyncpg is None:
+            raise RuntimeError("PostgreSQL backend requires asyncpg: pip install asyncpg")
+        super().__init__()
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self._pool = None
+
+    async def start(self):
+        if self._pool is None:
+            self._pool = await asyncpg.create_pool(self.dsn, min_size=self.min_size, max_size=self.max_size)
+
+    async def close(self):
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    # 用连接池中的连接执行 fn(conn, *args)
+    async def read(self, fn, *args):
+        async with self._pool.acquire() as conn:
+            return await fn(conn, *args)
+
+    # 在单个事务中执行 fn(conn, *args)
+    async def write(self, fn, *args):
+        async with self._pool.acquire() as conn:
+            async with conn.transaction():
+                return await fn(conn, *args)
+
+    # 执行尚未应用的结构迁移；连接池未启动时使用临时连接
+    async def migrate(self):
+        if self._pool is not None:
+            async with self._pool.acquire() as conn:
+                return await migrate_postgres(conn)
+        conn = await asyncpg.connect(self.dsn)
+        try:
+            return await migrate_postgres(conn)
+        finally:
+            await conn.close()
+
+    async def get_points(self, user_id):
+        async def _get(conn):
+            points = await conn.fetchval("SELECT points FROM users WHERE user_id = $1", user_id)
+            return points or 0
+        return await self.read(_get)
+
+    async def update_points(self, user_id, username, points_change, reason="admin", details=None):
+        points = await self.write(_add_points, user_id, username, points_change, reason, details)
+        points_log("points_changed", user=user_id, delta=points_change, balance=points)
+        self._notify([(user_id, username, points)])
+        return points
+
+    async def load_activity(self, user_id):
+        async def _load(conn):
+            row = await conn.fetchrow("""SELECT u.last_message, a.progress FROM users u
+                                         LEFT JOIN achievements a ON a.user_id = u.user_id AND a.achievement_name = $1
+                                         WHERE u.user_id = $2""", "活跃分子", user_id)
+            if row is None:
+                return None, 0
+            return (datetime.fromisoformat(row[0]) if row[0] else None), (row[1] or 0)
+        return await self.read(_load)
+
+    async def flush_activity(self, rows, members=()):
+        async def _flush(conn):
+            balances = []
+            for user_id, username, points, activity, last_message in rows:
+                balance = await conn.fetchval("""INSERT INTO users (user_id, username, points, last_message)
+                                                 VALUES ($1, $2, $3, $4)
+                                                 ON CONFLICT (user_id) DO UPDATE SET points = users.points + excluded.points,
+                                                 last_message = excluded.last_message,
+                                                 username = COALESCE(excluded.username, users.username)
+                                                 RETURNING points""",
+                                              user_id, username, points, last_message)
+                balances.append((user_id, balance))
+            now = ledger_time()
+            entries = [(row[0], None, row[2], balance, "chat", None, now)
+                       for row, (_, balance) in zip(rows, balances) if row[2]]
+            if entries:
+                await conn.executemany(LEDGER_INSERT, entries)
+            await conn.executemany("""INSERT INTO achievements (user_id, achievement_name, progress) VALUES ($1, $2, $3)
+                                      ON CONFLICT (user_id, achievement_name)
+                                      DO UPDATE SET progress = achievements.progress + excluded.progress""",
+                                   [(user_id, "活跃分子", activity) for user_id, _, _, activity, _ in rows])
+            joined = []
+            for chat_id, user_id in members:
+                if await conn.fetchval("""INSERT INTO chat_members (chat_id, user_id) VALUES ($1, $2)
+                                          ON CONFLICT DO NOTHING RETURNING 1""", chat_id, user_id):
+                    joined.append((chat_id, user_id))
+            logger.info(f"Flushed chat activity for {len(rows)} users")
+            return balances, joined
+        balances, joined = await self.write(_flush)
+        usernames = {row[0]: row[1] for row in rows}
+        self._notify([(user_id, usernames[user_id], points) for user_id, points in balances], joined)
+        return balances
+
+    async def settle_bet(self, user_id, username, stake, payout, streak=None, chat_id=None, details=None):
+        streak_sql = STREAK_SQL[streak]
+
+        async def _settle(conn):
+            row = await conn.fetchrow(f"""UPDATE users SET points = points - $1 + $2, consecutive_wins = {streak_sql},
+                                          username = COALESCE($3, username)
+                                          WHERE user_id = $4 AND points >= $1 RETURNING points, consecutive_wins""",
+                                      stake, payout, username, user_id)
+            if row is None:
+                raise InsufficientPoints(user_id)
+            await conn.execute(LEDGER_INSERT, user_id, chat_id, payout - stake, row[0], "bet", details, ledger_time())
+            joined = False
+            if chat_id is not None:
+                joined = _rowcount(await conn.execute(
+                    "INSERT INTO chat_members (chat_id, user_id) VALUES ($1, $2) ON CONFLICT DO NOTHING",
+                    chat_id, user_id)) > 0
+            return row[0], row[1], joined
+        balance, consecutive_wins, joined = await self.write(_settle)
+        points_log("bet_settled", user=user_id, stake=stake, payout=payout, balance=balance)
+        self._notify([(user_id, username, balance)], [(chat_id, user_id)] if joined else ())
+        return balance, consecutive_wins
+
+    async def settle_round(self, chat_id, bets):
+        async def _settle(conn):
+            results = []
+            entries = []
+            now = ledger_time()
+            for user_id, username, stake, payout, streak, details in bets:
+                row = await conn.fetchrow(f"""UPDATE users SET points = points - $1 + $2,
+                                              consecutive_wins = {STREAK_SQL[streak]}, username = COALESCE($3, username)
+                                              WHERE user_id = $4 AND points >= $1 RETURNING points, consecutive_wins""",
+                                          stake, payout, username, user_id)
+                results.append(tuple(row) if row else None)
+                if row:
+                    entries.append((user_id, chat_id, payout - stake, row[0], "round", details, now))
+            if entries:
+                await conn.executemany(LEDGER_INSERT, entries)
+            joined = []
+            for user_id in {bet[0] for bet, result in zip(bets, results) if result}:
+                if _rowcount(await conn.execute(
+                        "INSERT INTO chat_members (chat_id, user_id) VALUES ($1, $2) ON CONFLICT DO NOTHING",
+                        chat_id, user_id)) > 0:
+                    joined.append((chat_id, user_id))
+            return results, joined
+        results, joined = await self.write(_settle)
+        for (user_id, _, stake, payout, _, _), result in zip(bets, results):
+            if result:
+                points_log("bet_settled", user=user_id, stake=stake, payout=payout, balance=result[0])
+        self._notify([(bet[0], bet[1], result[0]) for bet, result in zip(bets, results) if result], joined)
+        return results
+
+    async def load_unlocked(self, user_id):
+        async def _load(conn):
+            rows = await conn.fetch("SELECT achievement_name FROM achievements WHERE user_id = $1 AND unlocked = 1",
+                                    user_id)
+            return {row[0] for row in rows}
+        return await self.read(_load)
+
+    async def load_unlocked_many(self, user_ids):
+        async def _load(conn):
+            unlocked = {user_id: set() for user_id in user_ids}
+            rows = await conn.fetch("""SELECT user_id, achievement_name FROM achievements
+                                       WHERE unlocked = 1 AND user_id = ANY($1::bigint[])""", list(user_ids))
+            for user_id, name in rows:
+                unlocked[user_id].add(name)
+            return unlocked
+        return await self.read(_load)
+
+    async def save_unlocks(self, user_id, unlocks):
+        async def _save(conn):
+            credited = {}
+            for name, reward in unlocks:
+                unlocked = await conn.fetchval("""INSERT INTO achievements (user_id, achievement_name, unlocked)
+                                                  VALUES ($1, $2, 1)
+                                                  ON CONFLICT (user_id, achievement_name) DO UPDATE SET unlocked = 1
+                                                  WHERE achievements.unlocked = 0 RETURNING 1""",
+                                               user_id, name)
+                if unlocked:
+                    credited[name] = await _add_points(conn, user_id, None, reward, "achievement", name)
+            return credited
+        credited = await self.write(_save)
+        rewards = dict(unlocks)
+        for name, points in credited.items():
+            points_log("points_changed", user=user_id, delta=rewards[name], balance=points)
+        if credited:
+            self._notify([(user_id, None, max(credited.values()))])
+        return credited
+
+    async def find_user_by_username(self, username):
+        async def _find(conn):
+            return await conn.fetchval("SELECT user_id FROM users WHERE username = $1", username)
+        return await self.read(_find)
+
+    # 全员加分；门槛成就用一条数据修改 CTE 完成判定、标记和发奖
+    async def grant_all(self, points_change, thresholds=()):
+        if not points_change:
+            return 0, {}
+        async def _grant(conn):
+            count = _rowcount(await conn.execute("UPDATE users SET points = points + $1", points_change))
+            now = ledger_time()
+            await conn.execute("""INSERT INTO ledger (user_id, delta, balance, reason, created_at)
+                                  SELECT user_id, $1, points, 'grant', $2 FROM users""", points_change, now)
+            unlocked = {}
+            for name, reward, min_points in thresholds:
+                rows = await conn.fetch("""WITH eligible AS (
+                                               SELECT u.user_id FROM users u
+                                               LEFT JOIN achievements a ON a.user_id = u.user_id AND a.achievement_name = $1
+                                               WHERE u.points >= $2 AND COALESCE(a.unlocked, 0) = 0
+                                           ), marked AS (
+                                               INSERT INTO achievements (user_id, achievement_name, unlocked)
+                                               SELECT user_id, $1, 1 FROM eligible
+                                               ON CONFLICT (user_id, achievement_name) DO UPDATE SET unlocked = 1
+                                           ), rewarded AS (
+                                               UPDATE users SET points = points + $3
+                                               WHERE user_id IN (SELECT user_id FROM eligible) RETURNING user_id, points
+                                           ), logged AS (
+                                               INSERT INTO ledger (user_id, delta, balance, reason, details, created_at)
+                                               SELECT user_id, $3, points, 'achievement', $1, $4 FROM rewarded
+                                           )
+                                           SELECT user_id FROM rewarded""",
+                                        name, min_points, reward, now)
+                unlocked[name] = [row[0] for row in rows]
+            logger.info(f"Granted {points_change} points to {count} users")
+            return count, unlocked
+        result = await self.write(_grant)
+        self._notify(None)
+        return result
+
+    async def get_fast_mode(self, chat_id):
+        async def _get(conn):
+            return bool(await conn.fetchval("SELECT fast_mode FROM chat_settings WHERE chat_id = $1", chat_id))
+        return await self.read(_get)
+
+    async def set_fast_mode(self, chat_id, enabled):
+        async def _set(conn):
+            await conn.execute("""INSERT INTO chat_settings (chat_id, fast_mode) VALUES ($1, $2)
+                                  ON CONFLICT (chat_id) DO UPDATE SET fast_mode = excluded.fast_mode""",
+                               chat_id, int(enabled))
+        await self.write(_set)
+
+    async def get_round_seconds(self, chat_id):
+        async def _get(conn):
+            return await conn.fetchval("SELECT round_seconds FROM chat_settings WHERE chat_id = $1", chat_id) or 0
+        return await self.read(_get)
+
+    async def set_round_seconds(self, chat_id, seconds):
+        async def _set(conn):
+            await conn.execute("""INSERT INTO chat_settings (chat_id, round_seconds) VALUES ($1, $2)
+                                  ON CONFLICT (chat_id) DO UPDATE SET round_seconds = excluded.round_seconds""",
+                               chat_id, seconds)
+        await self.write(_set)
+
+    async def recent_activity(self, limit=5000):
+        async def _recent(conn):
+            rows = await conn.fetch("SELECT chat_id, user_id FROM ledger ORDER BY id DESC LIMIT $1", limit)
+            chats = list(dict.fromkeys(chat_id for chat_id, _ in rows if chat_id is not None and chat_id < 0))
+            return chats, list(dict.fromkeys(user_id for _, user_id in rows))
+        return await self.read(_recent)
+
+    async def get_bot_setting(self, name):
+        async def _get(conn):
+            return await conn.fetchval("SELECT value FROM bot_settings WHERE name = $1", name)
+        return await self.read(_get)
+
+    async def set_bot_setting(self, name, value):
+        async def _set(conn):
+            await conn.execute("""INSERT INTO bot_settings (name, value) VALUES ($1, $2)
+                                  ON CONFLICT (name) DO UPDATE SET value = excluded.value""", name, value)
+        await self.write(_set)
+
+    async def load_dice_seeds(self, chat_id):
+        async def _load(conn):
+            rows = await conn.fetch("""SELECT shard, seed, revealed_seed, revealed_draws FROM dice_seeds
+                                       WHERE chat_id = $1 ORDER BY shard""", chat_id)
+            return [tuple(row) for row in rows]
+        return await self.read(_load)
+
+    async def save_dice_seeds(self, rows):
+        async def _save(conn):
+            await conn.executemany("""INSERT INTO dice_seeds (chat_id, shard, seed, revealed_seed, revealed_draws)
+                                      VALUES ($1, $2, $3, $4, $5) ON CONFLICT (chat_id, shard) DO UPDATE
+                                      SET seed = excluded.seed, revealed_seed = excluded.revealed_seed,
+                                      revealed_draws = excluded.revealed_draws""", rows)
+        await self.write(_save)
+
+    async def top_users(self, limit=5, offset=0, chat_id=None):
+        async def _top(conn):
+            if chat_id is None:
+                rows = await conn.fetch("""SELECT user_id, username, points FROM users
+                                           ORDER BY points DESC, user_id LIMIT $1 OFFSET $2""", limit, offset)
+            else:
+                rows = await conn.fetch("""SELECT u.user_id, u.username, u.points FROM chat_members m
+                                           JOIN users u ON u.user_id = m.user_id WHERE m.chat_id = $1
+                                           ORDER BY u.points DESC, u.user_id LIMIT $2 OFFSET $3""",
+                                        chat_id, limit, offset)
+            return [tuple(row) for row in rows]
+        return await self.read(_top)
+
+    async def rank(self, user_id, chat_id=None):
+        async def _rank(conn):
+            if chat_id is None:
+                points = await conn.fetchval("SELECT points FROM users WHERE user_id = $1", user_id)
+            else:
+                points = await conn.fetchval("""SELECT u.points FROM chat_members m JOIN users u ON u.user_id = m.user_id
+                                                WHERE m.chat_id = $1 AND m.user_id = $2""", chat_id, user_id)
+            if points is None:
+                return None
+            if chat_id is None:
+                ahead = await conn.fetchval("""SELECT COUNT(*) FROM users
+                                               WHERE points > $1 OR (points = $1 AND user_id < $2)""",
+                                            points, user_id)
+            else:
+                ahead = await conn.fetchval("""SELECT COUNT(*) FROM chat_members m JOIN users u ON u.user_id = m.user_id
+                                               WHERE m.chat_id = $1 AND (u.points > $2 OR (u.points = $2 AND u.user_id < $3))""",
+                                            chat_id, points, user_id)
+            return ahead + 1, points
+        return await self.read(_rank)
+
+    async def history(self, user_id, limit=10, offset=0):
+        async def _history(conn):
+            rows = await conn.fetch("""SELECT created_at, delta, balance, reason, details FROM ledger
+                                       WHERE user_id = $1 ORDER BY id DESC LIMIT $2 OFFSET $3""",
+                                    user_id, limit, offset)
+            return [tuple(row) for row in rows]
+        return await self.read(_history)
+
+    async def snapshot(self):
+        async def _snapshot(conn):
+            # SHARE 锁等待进行中的写流水事务提交并暂时阻止新的写入，保证快照流水号之前的流水都已计入余额
+            await conn.execute("LOCK TABLE ledger IN SHARE MODE")
+            last = await conn.fetchval("SELECT COALESCE(MAX(ledger_id), 0) FROM ledger_snapshots")
+            mark = await conn.fetchval("SELECT COALESCE(MAX(id), 0) FROM ledger")
+            if mark == last:
+                return mark, 0
+            count = _rowcount(await conn.execute("""INSERT INTO balance_snapshots (user_id, points, ledger_id)
+                                                    SELECT user_id, points, $1 FROM users
+                                                    WHERE user_id IN (SELECT DISTINCT user_id FROM ledger WHERE id > $2)
+                                                    ON CONFLICT (user_id) DO UPDATE SET points = excluded.points,
+                                                    ledger_id = excluded.ledger_id""", mark, last))
+            await conn.execute("INSERT INTO ledger_snapshots (ledger_id, users, created_at) VALUES ($1, $2, $3)",
+                               mark, count, ledger_time())
+            return mark, count
+        return await self.write(_snapshot)
+
+    async def compact_ledger(self, before):
+        async def _compact(conn):
+            mark = await conn.fetchval("SELECT COALESCE(MAX(ledger_id), 0) FROM ledger_snapshots")
+            return _rowcount(await conn.execute("DELETE FROM ledger WHERE id <= $1 AND created_at < $2", mark, before))
+        return await self.write(_compact)
+
+    async def audit(self, user_id=None, limit=100):
+        async def _audit(conn):
+            rows = await conn.fetch("""SELECT user_id, points, expected FROM (
+                                           SELECT u.user_id, u.points, COALESCE(s.points, 0) + COALESCE(
+                                               (SELECT SUM(l.delta) FROM ledger l
+                                                WHERE l.user_id = u.user_id AND l.id > COALESCE(s.ledger_id, 0)), 0) AS expected
+                                           FROM users u LEFT JOIN balance_snapshots s ON s.user_id = u.user_id
+                                           WHERE $1::BIGINT IS NULL OR u.user_id = $1
+                                       ) t WHERE points != expected LIMIT $2""", user_id, limit)
+            return [tuple(row) for row in rows]
+        return await self.read(_audit)
+
+    # 按主键顺序分批导出（键集分页）
+    async def export_rows(self, table, batch_size=1000):
+        columns = ", ".join(TABLES[table])
+        keys = PRIMARY_KEYS[table]
+        key_list = ", ".join(keys)
+        key_params = ", ".join(f"${i + 1}" for i in range(len(keys)))
+        last = None
+        while True:
+            if last is None:
+                query = f"SELECT {columns} FROM {table} ORDER BY {key_list} LIMIT {batch_size}"
+                rows = await self.read(lambda conn: conn.fetch(query))
+            else:
+                query = (f"SELECT {columns} FROM {table} WHERE ({key_list}) > ({key_params}) "
+                         f"ORDER BY {key_list} LIMIT {batch_size}")
+                rows = await self.read(lambda conn: conn.fetch(query, *last))
+            if not rows:
+                return
+            last = [rows[-1][key] for key in keys]
+            yield [tuple(row) for row in rows]
+
+    # 先 COPY 进临时表，再一条 INSERT ... ON CONFLICT DO NOTHING 合并，返回实际写入的行数
+    async def import_rows(self, table, rows):
+        columns = TABLES[table]
+        column_list = ", ".join(columns)
+
+        async def _import(conn):
+            await conn.execute(f"CREATE TEMP TABLE import_{table} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP")
+            await conn.copy_records_to_table(f"import_{table}", records=rows, columns=columns)
+            count = _rowcount(await conn.execute(f"""INSERT INTO {table} ({column_list})
+                                                     SELECT {column_list} FROM import_{table} ON CONFLICT DO NOTHING"""))
+            if "id" in columns:
+                # 导入了显式 id，把自增序列推进到最大值之后
+                await conn.execute(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                                   f"GREATEST((SELECT MAX(id) FROM {table}), 1))")
+            return count
+        count = await self.write(_import)
+        self._notify(None)
+        return count
+
+
+LEDGER_INSERT = """INSERT INTO ledger (user_id, chat_id, delta, balance, reason, details, created_at)
+                   VALUES ($1, $2, $3, $4, $5, $6, $7)"""
+
+
+async def _add_points(conn, user_id, username, points_change, reason, details=None):
+    points = await conn.fetchval("""INSERT INTO users (user_id, username, points) VALUES ($1, $2, $3)
+                                    ON CONFLICT (user_id) DO UPDATE SET points = users.points + excluded.points,
+                                    username = COALESCE(excluded.username, users.username) RETURNING points""",
+                                 user_id, username, points_change)
+    await conn.execute(LEDGER_INSERT, user_id, None, points_change, points, reason, details, ledger_time())
+    return points
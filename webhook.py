@@ -0,0 +1,58 @@
+import asyncio
+import logging
+import secrets
+import signal
+
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+
+# 以 webhook 方式运行：先停止接收新请求，再等待队列中和正在处理的更新全部完成后退出
+async def serve(app, listen="0.0.0.0", port=8443, url_path="", webhook_url=None, secret_token=None,
+                stop_event=None, drain_timeout=30.0, allowed_updates=Update.ALL_TYPES):
+    if not secret_token:
+        # 未配置时每次启动随机生成，setWebhook 会把它一并注册给 Telegram
+        secret_token = secrets.token_urlsafe(32)
+        logger.warning("WEBHOOK_SECRET not set, using a random secret token for this run")
+    stop_event = stop_event or asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    try:
+        await app.updater.start_webhook(listen=listen, port=port, url_path=url_path, webhook_url=webhook_url,
+                                        secret_token=secret_token, allowed_updates=allowed_updates)
+        await app.start()
+        logger.info(f"Webhook listening on {listen}:{port}/{url_path}")
+        await stop_event.wait()
+
+        logger.info("Stopping webhook, draining pending updates...")
+        await app.updater.stop()
+        try:
+            await asyncio.wait_for(_drain(app), drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"{app.update_queue.qsize()} updates still queued after {drain_timeout}s, dropping them")
+        # Application.stop 会等待并发处理中的更新完成
+        await app.stop()
+        if app.post_stop:
+            await app.post_stop(app)
+    finally:
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+
+
+async def _drain(app):
+    while not app.update_queue.empty():
+        await asyncio.sleep(0.05)
+
+
+def run_webhook(app, **kwargs):
+    asyncio.run(serve(app, **kwargs))
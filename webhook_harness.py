@@ -0,0 +1,106 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import tempfile
+import time
+
+# 离线 webhook 压测：用 FakeRequest 代替 Telegram，在本地启动 webhook 服务并并发 POST 合成的 Update JSON
+# 用法：python webhook_harness.py --updates 2000 --concurrency 50 --concurrent-updates 16
+
+SECRET = "harness-secret"
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _workload(count, users, chats):
+    texts = ["你好", "今天手气怎么样", "/play size big 10", "/play sum 10 5", "/balance", "/leaderboard"]
+    for update_id in range(1, count + 1):
+        user_id = random.randint(1, users)
+        yield update_id, user_id, -random.randint(1, chats), random.choice(texts)
+
+
+async def run(args):
+    import httpx
+
+    import bot
+    from fake_telegram import FakeRequest, make_update
+    from webhook import serve
+
+    request = FakeRequest()
+    app = bot.build_application("123456:HARNESS", request=request)
+    await bot.storage.migrate()
+    await bot.storage.write(lambda c: c.executemany(
+        "INSERT OR IGNORE INTO users (user_id, username, points) VALUES (?, ?, 1000000)",
+        [(user_id, f"user{user_id}") for user_id in range(1, args.users + 1)]))
+
+    port = _free_port()
+    stop_event = asyncio.Event()
+    server = asyncio.create_task(serve(app, listen="127.0.0.1", port=port, url_path="webhook",
+                                       secret_token=SECRET, stop_event=stop_event))
+    url = f"http://127.0.0.1:{port}/webhook"
+    async with httpx.AsyncClient(timeout=30) as client:
+        for _ in range(100):
+            try:
+                await client.post(url, content=b"{}", headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"})
+                break
+            except httpx.TransportError:
+                await asyncio.sleep(0.05)
+        rejected = (await client.post(url, content=json.dumps(make_update(0, 1, -1, "hi")),
+                                      headers={"X-Telegram-Bot-Api-Secret-Token": "wrong",
+                                               "Content-Type": "application/json"})).status_code
+        request.reset()
+
+        statuses = {}
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def post(update):
+            async with semaphore:
+                response = await client.post(url, content=json.dumps(update),
+                                             headers={"X-Telegram-Bot-Api-Secret-Token": SECRET,
+                                                      "Content-Type": "application/json"})
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(post(make_update(*item)) for item in _workload(args.updates, args.users, args.chats)))
+        accepted = time.perf_counter() - started
+        # 停止并等待全部更新处理完毕
+        stop_event.set()
+        await server
+        elapsed = time.perf_counter() - started
+
+    print(f"wrong secret -> HTTP {rejected}")
+    print(f"updates: {args.updates}, HTTP statuses: {statuses}")
+    print(f"accepted in {accepted:.2f}s ({args.updates / accepted:.0f}/s), "
+          f"processed in {elapsed:.2f}s ({args.updates / elapsed:.0f} updates/s)")
+    print(f"API calls: {sum(request.calls.values())} {dict(request.calls)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline webhook throughput harness")
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--chats", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=50, help="concurrent HTTP posts")
+    parser.add_argument("--concurrent-updates", type=int, default=16, help="Application concurrent_updates")
+    args = parser.parse_args()
+    os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(), "harness.db"))
+    os.environ["CONCURRENT_UPDATES"] = str(args.concurrent_updates)
+    # 压测时关闭限流，测的是处理能力
+    os.environ.setdefault("RATE_LIMIT_USER", "1000000/1")
+    os.environ.setdefault("RATE_LIMIT_CHAT", "1000000/1")
+    os.environ.setdefault("RATE_LIMIT_COMMANDS", "")
+    os.environ.setdefault("RATE_LIMIT_OUTGOING", "1000000/1")
+    os.environ.setdefault("RATE_LIMIT_GROUP_CHAT", "1000000/1")
+    os.environ.setdefault("RATE_LIMIT_PRIVATE_CHAT", "1000000/1")
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()